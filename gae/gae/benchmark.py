@@ -0,0 +1,64 @@
+"""Compare test accuracy and training speed of train.py across the values of one flag.
+
+    python benchmark.py --flag reduce_dim --values 0,16,64,256 -- --dataset citeseer --test_count 5
+
+Every value runs train.py in a fresh process with --verbose 0; arguments after
+"--" are passed to every run.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import re
+import subprocess
+import sys
+import time
+
+FLOAT = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan'
+
+def parse_summary(output):
+    """Mean test accuracy and its standard error, seconds per training step, for the first step and
+    until the selected epoch, and peak memory in MB."""
+    acc = sem = step = first = selected = peak = float('nan')
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('(') and line.endswith(')'):
+            numbers = [float(x) for x in re.findall(FLOAT, re.sub(r'np\.float\d+', '', line))]
+            if len(numbers) >= 2:
+                acc, sem = numbers[0], numbers[1]
+        elif line.startswith('seconds per training step:'):
+            step = float(line.split(':')[1])
+        elif line.startswith('seconds for first training step:'):
+            first = float(line.split(':')[1])
+        elif line.startswith('seconds to selected epoch:'):
+            selected = float(line.split(':')[1])
+        elif line.startswith('peak memory (MB):'):
+            peak = float(line.split(':')[1])
+    return acc, sem, step, first, selected, peak
+
+def run(flag, value, train_args):
+    cmd = [sys.executable, 'train.py', '--verbose=0', '--{}={}'.format(flag, value)] + train_args
+    start = time.time()
+    output = subprocess.check_output(cmd, universal_newlines=True)
+    return parse_summary(output) + (time.time() - start,)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--flag', required=True, help='train.py flag to vary')
+    parser.add_argument('--values', required=True, help='comma separated values of the flag')
+    parser.add_argument('--sep', default=',', help='separator of --values, for values containing commas')
+    parser.add_argument('train_args', nargs='*', help='extra train.py arguments (after --)')
+    args = parser.parse_args()
+
+    print('{:>12} {:>10} {:>8} {:>12} {:>12} {:>12} {:>10} {:>10}'.format(args.flag, 'test_acc', 'sem', 'sec/step',
+                                                                          'first_step', 'to_selected', 'peak_mb',
+                                                                          'wall_sec'))
+    for value in args.values.split(args.sep):
+        acc, sem, step, first, selected, peak, wall = run(args.flag, value, args.train_args)
+        print('{:>12} {:>10.5f} {:>8.5f} {:>12.5f} {:>12.5f} {:>12.2f} {:>10.1f} {:>10.1f}'.format(
+            value, acc, sem, step, first, selected, peak, wall))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Run train.py jobs in a warm worker daemon over a Unix socket (Python 3).
+
+    python daemon.py --unix /tmp/gae-train.sock
+    python daemon.py --unix /tmp/gae-train.sock --submit -- --dataset citeseer --model gcn --epochs 50
+
+The daemon imports train.py (and with it TensorFlow) once and keeps the
+datasets prepared by train.prepare_data() in memory. Every job runs in a
+process forked from the daemon: it starts with these imports and data already
+loaded, gets a fresh TensorFlow graph and its own flags, and nothing it does
+outlives it. At most --jobs jobs run at once. Requests and responses are JSON
+objects, one per line:
+
+    {"op": "train", "args": ["--dataset", "citeseer", "--epochs", "50"]}
+    {"op": "train", "flags": {"dataset": "citeseer", "epochs": 50}}
+        -> {"results": {...}, "output": "...", "train_sec": ..., "wall_sec": ...}
+    {"op": "status"}  -> {"pid": ..., "datasets": [...], "running": ...}
+
+"results" are the arrays returned by train.train(), "output" is what the job
+printed (the same as train.py with these flags) and "train_sec" the time spent
+in train.train(); the rest of "wall_sec" is the overhead of the daemon. With
+--submit, the arguments after "--" are sent as a train job and its output is
+printed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# train.py and its flags, imported by the daemon only (not by --submit)
+train = None
+FLAGS = None
+
+def encode(response):
+    return (json.dumps(response) + '\n').encode()
+
+def error(e):
+    return encode({'error': '{}: {}'.format(type(e).__name__, e)})
+
+def configure(request):
+    """Sets the train.py flags of a job: defaults, then its "args" or "flags"."""
+    from sweep import configure as configure_flags
+    configure_flags(request.get('flags', {}))
+    if 'args' in request:
+        FLAGS([sys.argv[0]] + [str(arg) for arg in request['args']])
+
+def serializable(results):
+    return {name: [np.asarray(v).tolist() for v in value] if isinstance(value, list) else np.asarray(value).tolist()
+            for name, value in results.items()}
+
+def run_child(write_fd):
+    """Body of a forked job: trains, writes the response to write_fd and exits."""
+    status = 0
+    out = tempfile.TemporaryFile()
+    try:
+        # what the job prints goes to its response instead of the daemon's stdout
+        sys.stdout.flush()
+        os.dup2(out.fileno(), 1)
+        start = time.time()
+        results = train.train()
+        train.report(results)
+        response = {'results': serializable(results), 'train_sec': time.time() - start}
+    except BaseException as e:
+        response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        status = 1
+    sys.stdout.flush()
+    out.seek(0)
+    response['output'] = out.read().decode('utf-8', 'replace')
+    with os.fdopen(write_fd, 'wb') as f:
+        f.write(json.dumps(response).encode())
+    os._exit(status)
+
+def run_job(request, lock):
+    """Forks a process for a train job and returns its response (run in a worker thread)."""
+    start = time.time()
+    # flags are process-wide: set them and fork before another job changes them
+    with lock:
+        configure(request)
+        train.prepare_data(FLAGS.dataset, FLAGS.featureless, FLAGS.reduce_dim, FLAGS.reduce_method, FLAGS.reorder)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            run_child(write_fd)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('job exited with status {}'.format(status))
+    response = json.loads(data.decode())
+    response['wall_sec'] = time.time() - start
+    return response
+
+async def handle(state, reader, writer):
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if request['op'] == 'train':
+                    state['running'] += 1
+                    try:
+                        async with state['slots']:
+                            response = await loop.run_in_executor(None, run_job, request, state['lock'])
+                    finally:
+                        state['running'] -= 1
+                elif request['op'] == 'status':
+                    response = {'pid': os.getpid(), 'datasets': [list(key) for key in train._prepared],
+                                'running': state['running']}
+                else:
+                    raise KeyError(request['op'])
+                if 'id' in request:
+                    response['id'] = request['id']
+            except Exception as e:
+                writer.write(error(e))
+            else:
+                writer.write(encode(response))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def serve(args):
+    global train, FLAGS
+    import train
+    from train import FLAGS
+    # parse no command line flags, every job sets its own
+    FLAGS([sys.argv[0]])
+
+    state = {'lock': threading.Lock(), 'slots': asyncio.Semaphore(args.jobs), 'running': 0}
+    if os.path.exists(args.unix):
+        os.remove(args.unix)
+    server = await asyncio.start_unix_server(lambda reader, writer: handle(state, reader, writer), path=args.unix)
+    print('running train.py jobs on {} (pid {})'.format(args.unix, os.getpid()))
+    sys.stdout.flush()
+    async with server:
+        await server.serve_forever()
+
+def submit(path, request):
+    """Sends one request to a daemon and returns its response."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    with sock, sock.makefile('rwb') as f:
+        f.write(encode(request))
+        f.flush()
+        return json.loads(f.readline().decode())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--unix', required=True, help='Unix socket of the daemon')
+    parser.add_argument('--jobs', type=int, default=1, help='jobs running at once')
+    parser.add_argument('--submit', action='store_true', help='send a train job to a running daemon')
+    parser.add_argument('train_args', nargs='*', help='train.py arguments of --submit (after --)')
+    args = parser.parse_args()
+
+    if not args.submit:
+        asyncio.run(serve(args))
+        return
+    response = submit(args.unix, {'op': 'train', 'args': args.train_args})
+    sys.stdout.write(response.get('output', ''))
+    if 'error' in response:
+        print(response['error'], file=sys.stderr)
+        sys.exit(1)
+    print('job: {:.2f} sec, {:.2f} sec in train()'.format(response['wall_sec'], response['train_sec']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Distill a model saved by train.py --save_dir into a graph-free MLP student.
+
+    python train.py --dataset citeseer --model graphite --save_dir saved/citeseer
+    python distill.py --teacher_dir saved/citeseer --position_dim 16
+
+The student (model.MLPModel, Dense layers only) is trained on the node features
+to match the teacher's class distribution on all nodes, optionally with
+positional features of the graph (random projections propagated over it,
+preprocessing.positional_features). Its test accuracy is then compared
+with the teacher's, together with the latency of predicting batches of nodes:
+the teacher's full forward pass, its k-hop subgraph pass (Predictor.forward_nodes)
+and the student's pass on the feature rows of the nodes alone.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+
+import tensorflow as tf
+import numpy as np
+import scipy.stats as stats
+
+from inference import Predictor
+from input_data import load_graph_data
+from model import MLPModel
+from optimizer import OptimizerDistill
+from preprocessing import model_inputs, positional_features, sparse_to_tuple
+
+flags = tf.app.flags
+FLAGS = flags.FLAGS
+flags.DEFINE_string('teacher_dir', '', 'Model saved by train.py --save_dir')
+flags.DEFINE_string('hidden', '64', 'Comma separated hidden layer sizes of the student')
+flags.DEFINE_float('learning_rate', 0.01, 'Initial learning rate.')
+flags.DEFINE_integer('epochs', 300, 'Number of epochs to train.')
+flags.DEFINE_float('dropout', 0.5, 'Dropout rate (1 - keep probability).')
+flags.DEFINE_float('weight_decay', 5e-4, 'Weight for L2 loss on the first layer.')
+flags.DEFINE_float('temperature', 1., 'Softmax temperature of the teacher and student distributions')
+flags.DEFINE_float('hard_weight', 0., 'Weight of the cross-entropy on the training labels')
+flags.DEFINE_integer('position_dim', 0, 'Positional features (propagated random projections) given to the student (0 for none)')
+flags.DEFINE_integer('pick_best', 1, 'choose arg based on val')
+flags.DEFINE_integer('test_count', 1, 'batch of tests')
+flags.DEFINE_integer('verbose', 1, 'verboseness')
+flags.DEFINE_integer('seeded', 0, 'Set numpy random seed')
+flags.DEFINE_string('latency_batches', '1,64,1024', 'Comma separated numbers of query nodes timed')
+flags.DEFINE_integer('latency_repeats', 20, 'Timed repetitions per batch size (the median is reported)')
+
+def accuracy(logits, targets, mask):
+    """Share of the masked nodes whose highest logit is the highest target."""
+    return np.mean(logits[mask].argmax(1) == targets[mask].argmax(1))
+
+def median_seconds(fn, repeats):
+    fn()
+    times = []
+    for _ in range(repeats):
+        t = time.time()
+        fn()
+        times.append(time.time() - t)
+    return np.median(times)
+
+if FLAGS.seeded:
+    np.random.seed(123)
+    tf.set_random_seed(123)
+
+teacher = Predictor(FLAGS.teacher_dir)
+adj, features, y_train, y_val, y_test, train_mask, val_mask, test_mask = load_graph_data(teacher.graph_dir)
+num_nodes = adj.shape[0]
+labels = y_train + y_val + y_test
+teacher_logits = teacher.logits.astype(np.float32)
+teacher_acc = accuracy(teacher_logits, labels, test_mask)
+
+positions = None
+if FLAGS.position_dim > 0:
+    t = time.time()
+    positions = positional_features(adj, FLAGS.position_dim)
+    if FLAGS.verbose:
+        print("positional features: {:.2f} sec".format(time.time() - t))
+
+# input format of the student, fixed by the full features for every batch of rows
+indexed = model_inputs(features, teacher.featureless, num_nodes)[1] is not None
+
+def student_inputs(nodes):
+    """Feed values of the student inputs for the given nodes."""
+    inputs = model_inputs(features[nodes], teacher.featureless, len(nodes), indexed)
+    if teacher.featureless:
+        inputs = (None, nodes) + inputs[2:]
+    return inputs
+
+hidden_dims = [int(dim) for dim in FLAGS.hidden.split(',') if dim]
+runs = np.zeros(FLAGS.test_count)
+fidelities = np.zeros(FLAGS.test_count)
+for run in range(FLAGS.test_count):
+    tf.reset_default_graph()
+    all_nodes = np.arange(num_nodes)
+    inputs, feature_index, num_features, features_nonzero = student_inputs(all_nodes)
+
+    placeholders = {
+        'dropout': tf.placeholder_with_default(0., shape=()),
+        'labels': tf.placeholder(tf.float32, shape=(None, labels.shape[1])),
+        'labels_mask': tf.placeholder(tf.int32),
+        'teacher': tf.placeholder(tf.float32, shape=(None, labels.shape[1])),
+    }
+    if isinstance(inputs, np.ndarray):
+        placeholders['features'] = tf.placeholder(tf.float32, shape=(None, num_features))
+    elif feature_index is None:
+        placeholders['features'] = tf.sparse_placeholder(tf.float32)
+    else:
+        placeholders['feature_index'] = tf.placeholder(tf.int64, shape=[None])
+    if positions is not None:
+        placeholders['positions'] = tf.placeholder(tf.float32, shape=(None, FLAGS.position_dim))
+
+    model = MLPModel(placeholders, num_features, features_nonzero, hidden_dims)
+    with tf.name_scope('optimizer'):
+        opt = OptimizerDistill(model, placeholders['teacher'], FLAGS.learning_rate, FLAGS.temperature,
+                               FLAGS.hard_weight)
+
+    def feed_dict(nodes, inputs=None):
+        inputs = inputs or student_inputs(nodes)
+        feed_dict = {placeholders['feature_index']: inputs[1]} if inputs[1] is not None else \
+            {placeholders['features']: inputs[0]}
+        if positions is not None:
+            feed_dict[placeholders['positions']] = positions[nodes]
+        return feed_dict
+
+    base_feed_dict = feed_dict(all_nodes, (inputs, feature_index))
+    base_feed_dict[placeholders['teacher']] = teacher_logits
+    train_feed_dict = dict(base_feed_dict)
+    train_feed_dict.update({placeholders['labels']: y_train, placeholders['labels_mask']: train_mask,
+                            placeholders['dropout']: FLAGS.dropout})
+
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+
+    vals = np.zeros(FLAGS.epochs)
+    tests = np.zeros(FLAGS.epochs)
+    test_fidelities = np.zeros(FLAGS.epochs)
+    for epoch in range(FLAGS.epochs):
+        avg_cost, avg_accuracy = sess.run([opt.opt_op, opt.cost, opt.accuracy], feed_dict=train_feed_dict)[1:]
+        # one pass without dropout for the validation and test metrics
+        logits = sess.run(model.outputs, feed_dict=base_feed_dict)
+        vals[epoch] = accuracy(logits, labels, val_mask)
+        tests[epoch] = accuracy(logits, labels, test_mask)
+        # share of the test nodes on which student and teacher predict the same class
+        test_fidelities[epoch] = accuracy(logits, teacher_logits, test_mask)
+        if FLAGS.verbose:
+            print("Epoch:", '%04d' % (epoch + 1), "train_loss=", "{:.5f}".format(avg_cost),
+                  "train_acc=", "{:.5f}".format(avg_accuracy), "val_acc=", "{:.5f}".format(vals[epoch]),
+                  "test_agreement=", "{:.5f}".format(test_fidelities[epoch]))
+
+    arg = np.argmax(vals) if FLAGS.pick_best else FLAGS.epochs - 1
+    runs[run] = tests[arg]
+    fidelities[run] = test_fidelities[arg]
+    if run < FLAGS.test_count - 1:
+        sess.close()
+
+print("teacher test accuracy:", "{:.5f}".format(teacher_acc))
+print("student test accuracy:", "{:.5f}".format(np.mean(runs)),
+      "sem", "{:.5f}".format(stats.sem(runs) if len(runs) > 1 else 0.))
+print("student-teacher agreement on test nodes:", "{:.5f}".format(np.mean(fidelities)))
+
+# latency of the last student, inputs prepared from the raw features inside the timed call
+adj_tuple = sparse_to_tuple(teacher.graph_inputs[0])
+rng = np.random.RandomState(0)
+full = median_seconds(lambda: teacher.forward(adj_tuple, teacher.graph_inputs[1], all_nodes), FLAGS.latency_repeats)
+print('{:>8} {:>14} {:>14} {:>14}'.format('nodes', 'teacher_full', 'teacher_khop', 'student'))
+for batch in [int(b) for b in FLAGS.latency_batches.split(',') if b]:
+    nodes = np.sort(rng.choice(num_nodes, min(batch, num_nodes), replace=False))
+    khop = median_seconds(lambda: teacher.forward_nodes(nodes), FLAGS.latency_repeats)
+    student = median_seconds(lambda: sess.run(model.outputs, feed_dict=feed_dict(nodes)), FLAGS.latency_repeats)
+    print('{:>8} {:>11.3f} ms {:>11.3f} ms {:>11.3f} ms'.format(len(nodes), 1e3 * full, 1e3 * khop, 1e3 * student))
+    sys.stdout.flush()
+sess.close()
@@ -0,0 +1,187 @@
+"""Export the embeddings and class probabilities of a model saved by train.py --save_dir.
+
+    python export.py --model_dir saved/cora --out_dir exports/cora
+    python export.py --model_dir saved/cora --out_dir exports/cora --dtype int8
+
+Every array gets one row per node of the saved graph:
+
+    embeddings  model.embeddings (z1q_mean for graphite, the hidden layer for gcn)
+    decoded     the decoder_x embeddings of z1q_mean (graphite only)
+    probs       class probabilities
+
+Rows are computed in chunks of --chunk_size nodes, each chunk on its k-hop
+subgraph, and written straight into memory-mapped .npy files, so neither the
+model pass nor the written arrays need the whole graph at once. Once the
+subgraph of a chunk holds more than half of the nodes (graphs with little
+locality), the remaining rows come from one pass over the whole graph, which
+is then cheaper than the chunks. The decoder_x
+embeddings mix all nodes through the graph reconstructed from z1 and are
+computed in one pass with the exported z1 means fed in (skipping the encoder).
+
+With --dtype int8 every row is quantized with its own scale: row i is about
+values[i] * scales[i]. export.json lists the arrays and the dataset, graph
+version, training flags and checkpoint they come from. load_export() opens
+them with mmap_mode='r', so readers only page in the rows they touch.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from inference import Predictor, softmax
+from preprocessing import induced_subgraph, khop_nodes, sparse_to_tuple
+
+EXPORT = 'export.json'
+EXPORT_FORMAT = 1
+
+def quantize_rows(x):
+    """Symmetric int8 quantization with one scale per row: x ~ values * scales[:, None]."""
+    scales = np.abs(x).max(axis=1) / 127.
+    scales[scales == 0] = 1.
+    return np.rint(x / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+class RowWriter(object):
+    """A (num_rows, dim) array written by row ranges into memory-mapped .npy files.
+
+    Files are written under a .tmp name and moved in place by close(), so
+    readers never map a partially written array.
+    """
+    def __init__(self, out_dir, name, num_rows, dim, dtype):
+        self.out_dir = out_dir
+        self.quantized = np.dtype(dtype) == np.int8
+        self.files = {'values': name + '.npy'}
+        self.values = self._open(self.files['values'], (num_rows, dim), dtype)
+        if self.quantized:
+            self.files['scales'] = name + '.scales.npy'
+            self.scales = self._open(self.files['scales'], (num_rows,), np.float32)
+
+    def _open(self, filename, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(self.out_dir, filename + '.tmp'), mode='w+',
+                                         dtype=dtype, shape=shape)
+
+    def write(self, start, rows):
+        stop = start + rows.shape[0]
+        if self.quantized:
+            self.values[start:stop], self.scales[start:stop] = quantize_rows(rows)
+        else:
+            self.values[start:stop] = rows
+
+    def close(self):
+        self.values.flush()
+        self.values = None
+        if self.quantized:
+            self.scales.flush()
+            self.scales = None
+        for filename in self.files.values():
+            os.rename(os.path.join(self.out_dir, filename + '.tmp'), os.path.join(self.out_dir, filename))
+        return {'files': self.files, 'dtype': 'int8' if self.quantized else 'float32'}
+
+def read_export(path):
+    with open(os.path.join(path, EXPORT)) as f:
+        manifest = json.load(f)
+    assert manifest['format'] == EXPORT_FORMAT, 'Unsupported export format: ' + str(manifest['format'])
+    return manifest
+
+def load_export(path):
+    """Manifest and arrays of an export, memory-mapped read-only; int8 arrays come as (values, scales)."""
+    manifest = read_export(path)
+    arrays = {}
+    for name, array in manifest['arrays'].items():
+        files = array['files']
+        values = np.load(os.path.join(path, files['values']), mmap_mode='r')
+        if 'scales' in files:
+            arrays[name] = (values, np.load(os.path.join(path, files['scales']), mmap_mode='r'))
+        else:
+            arrays[name] = values
+    return manifest, arrays
+
+def export(predictor, out_dir, dtype='float32', chunk_size=65536):
+    """Writes the exported arrays of every node of the predictor's graph to out_dir; returns the manifest."""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    previous = read_export(out_dir) if os.path.exists(os.path.join(out_dir, EXPORT)) else None
+    adj_norm, features = predictor.graph_inputs
+    num_nodes = adj_norm.shape[0]
+    if chunk_size <= 0:
+        chunk_size = num_nodes
+
+    def chunk_outputs(nodes):
+        ball = khop_nodes(adj_norm, nodes, predictor.receptive_field)
+        if 2 * len(ball) > num_nodes:
+            return None
+        logits, emb = predictor.forward(sparse_to_tuple(induced_subgraph(adj_norm, ball)),
+                                        None if features is None else features[ball], ball)
+        rows = np.searchsorted(ball, nodes)
+        return logits[rows], emb[rows]
+
+    writers = {}
+    # outputs of all nodes, once chunks stop paying off
+    full = None
+    # z1 means feeding the decoder_x pass, kept at full precision
+    means = None
+    for start in range(0, num_nodes, chunk_size):
+        nodes = np.arange(start, min(start + chunk_size, num_nodes))
+        outputs = chunk_outputs(nodes) if full is None else None
+        if outputs is None:
+            if full is None:
+                full = predictor.forward(sparse_to_tuple(adj_norm), features, np.arange(num_nodes))
+            outputs = [output[nodes] for output in full]
+        logits, emb = outputs
+        if not writers:
+            writers['embeddings'] = RowWriter(out_dir, 'embeddings', num_nodes, emb.shape[1], dtype)
+            writers['probs'] = RowWriter(out_dir, 'probs', num_nodes, logits.shape[1], dtype)
+            if predictor.decoded is not None:
+                means = np.zeros((num_nodes, emb.shape[1]), dtype=np.float32)
+        writers['embeddings'].write(start, emb)
+        writers['probs'].write(start, softmax(logits))
+        if means is not None:
+            means[start:start + len(nodes)] = emb
+
+    if means is not None:
+        decoded, = predictor.forward(sparse_to_tuple(adj_norm), features, np.arange(num_nodes),
+                                     [predictor.decoded], embeddings=means)
+        writers['decoded'] = RowWriter(out_dir, 'decoded', num_nodes, decoded.shape[1], dtype)
+        for start in range(0, num_nodes, chunk_size):
+            writers['decoded'].write(start, decoded[start:start + chunk_size])
+
+    metadata = predictor.metadata
+    manifest = {'format': EXPORT_FORMAT, 'dataset': metadata.get('dataset'), 'model': metadata['model'],
+                'graph_version': predictor.version, 'num_nodes': int(num_nodes), 'chunk_size': int(chunk_size),
+                'flags': metadata.get('flags', {}),
+                'checkpoint': {'path': os.path.abspath(predictor.checkpoint), 'epoch': metadata.get('epoch'),
+                               'val_acc': metadata.get('val_acc'), 'test_acc': metadata.get('test_acc')},
+                'arrays': {name: writer.close() for name, writer in writers.items()}}
+    tmp = os.path.join(out_dir, EXPORT + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp, os.path.join(out_dir, EXPORT))
+
+    if previous:
+        kept = set(f for array in manifest['arrays'].values() for f in array['files'].values())
+        for array in previous['arrays'].values():
+            for filename in set(array['files'].values()) - kept:
+                os.remove(os.path.join(out_dir, filename))
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model_dir', required=True, help='directory given to train.py --save_dir')
+    parser.add_argument('--out_dir', required=True)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'int8'])
+    parser.add_argument('--chunk_size', type=int, default=65536, help='nodes per chunk (0 for a single pass)')
+    args = parser.parse_args()
+
+    start = time.time()
+    manifest = export(Predictor(args.model_dir, cache=False), args.out_dir, args.dtype, args.chunk_size)
+    print('exported {} ({} nodes, graph version {}) to {} in {:.1f} sec'.format(
+        ', '.join(sorted(manifest['arrays'])), manifest['num_nodes'], manifest['graph_version'], args.out_dir,
+        time.time() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""Inference with a model saved by train.py --save_dir.
+
+The save directory holds a checkpoint of the model variables (whose meta graph
+carries the placeholders and output tensors in 'serving/' collections), the
+graph it was trained on in the on-disk format, and serving.json describing both.
+The graph keeps the node ids it was loaded with; when train.py reordered the
+nodes (--reorder), the permutation is saved as well, since the weight rows of
+featureless models follow the order they were trained in.
+"""
+
+import json
+import os
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+import tensorflow as tf
+
+from input_data import load_graph, read_manifest, save_graph
+from preprocessing import NormalizedAdjacency, induced_subgraph, khop_nodes, model_inputs, restore_order, sparse_to_tuple
+
+SERVING = 'serving.json'
+CHECKPOINT = 'model'
+GRAPH = 'graph'
+NODE_ORDER = 'node_order.npy'
+
+# hops of neighborhood a node's outputs depend on
+RECEPTIVE_FIELD = {'gcn': 2, 'graphite': 4, 'graphite_kingma': 4}
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+def _append_rows(array, rows):
+    """A copy of array (dense or sparse) with the given rows appended."""
+    if sp.issparse(array):
+        return sp.vstack((array, sp.csr_matrix(rows, dtype=array.dtype)), format='csr')
+    return np.concatenate((array, np.asarray(rows, dtype=array.dtype).reshape((-1,) + array.shape[1:])))
+
+class Exporter(object):
+    """Saves a model built by train.py so that Predictor can load it without the model code."""
+    def __init__(self, save_dir, model, placeholders):
+        self.save_dir = save_dir
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+        for key, tensor in model.export_tensors().items():
+            tf.add_to_collection('serving/' + key, tensor)
+        for key, placeholder in placeholders.items():
+            # sparse placeholders are stored as their indices, values and shape
+            if isinstance(placeholder, tf.SparseTensor):
+                for tensor in (placeholder.indices, placeholder.values, placeholder.dense_shape):
+                    tf.add_to_collection('serving/' + key, tensor)
+            else:
+                tf.add_to_collection('serving/' + key, placeholder)
+        self.saver = tf.train.Saver(model.vars, max_to_keep=1)
+        self.embedding_hops = model.embedding_hops
+        self.node_order = None
+
+    def save_graph(self, adj, features, labels=None, idx_train=None, idx_val=None, idx_test=None, name=None,
+                   perm=None):
+        """Saves the graph served with the model; features as given to train.py, before normalization.
+
+        perm is the node permutation the model was trained under (node i of the
+        trained graph is node perm[i] of the saved one), None if there was none.
+        """
+        if perm is not None:
+            np.save(os.path.join(self.save_dir, NODE_ORDER), perm)
+            self.node_order = NODE_ORDER
+        return save_graph(os.path.join(self.save_dir, GRAPH), adj, features, labels, idx_train, idx_val, idx_test,
+                          name=name)
+
+    def save(self, sess, model_str, featureless, **metadata):
+        self.saver.save(sess, os.path.join(self.save_dir, CHECKPOINT))
+        metadata.update({'model': model_str, 'featureless': bool(featureless),
+                         'receptive_field': RECEPTIVE_FIELD.get(model_str, 2),
+                         'embedding_hops': self.embedding_hops,
+                         'checkpoint': CHECKPOINT, 'graph': GRAPH, 'node_order': self.node_order})
+        tmp = os.path.join(self.save_dir, SERVING + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(metadata, f, indent=2, sort_keys=True)
+        os.rename(tmp, os.path.join(self.save_dir, SERVING))
+
+class Predictor(object):
+    """Runs a saved model and caches its outputs for the graph saved with it.
+
+    refresh() reloads the graph and recomputes the cache only when the version
+    in its manifest changed; insert() grows the graph in memory and recomputes
+    the outputs near the change only. Cached arrays are replaced, never updated
+    in place, and every query reads a single one of them, so queries can be
+    answered from another thread while a refresh or an insert is running.
+
+    With cache=False only the graph is loaded, for callers running the model
+    on parts of it themselves (forward_nodes, export.py).
+    """
+    def __init__(self, save_dir, cache=True):
+        with open(os.path.join(save_dir, SERVING)) as f:
+            self.metadata = json.load(f)
+        self.graph_dir = os.path.join(save_dir, self.metadata['graph'])
+        self.featureless = self.metadata['featureless']
+        self.receptive_field = self.metadata['receptive_field']
+        self.embedding_hops = self.metadata.get('embedding_hops')
+        # trained position of every saved node, for the weight rows of featureless models
+        self.trained_rows = None
+        if self.metadata.get('node_order'):
+            perm = np.load(os.path.join(save_dir, self.metadata['node_order']))
+            self.trained_rows = restore_order(np.arange(len(perm)), perm)
+
+        self.graph = tf.Graph()
+        self.sess = tf.Session(graph=self.graph)
+        self.checkpoint = os.path.join(save_dir, self.metadata['checkpoint'])
+        with self.graph.as_default():
+            saver = tf.train.import_meta_graph(self.checkpoint + '.meta', clear_devices=True)
+            saver.restore(self.sess, self.checkpoint)
+        self.outputs = self._tensor('outputs')
+        self.embeddings = self._tensor('embeddings')
+        # decoder_x embeddings of the graphite models, None for the others
+        self.decoded = self._tensor('decoded')
+        self.placeholders = {key: self._tensor(key) for key in ('adj', 'features', 'feature_index')}
+        # features are looked up by index (featureless or one-hot) or fed, as the model was built
+        self.indexed = self.placeholders['feature_index'] is not None
+
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.version = None
+        self.adjacency = None
+        self.graph_inputs = None
+        self.logits = None
+        self.probs = None
+        self.emb = None
+        self.refresh()
+
+    def _tensor(self, key):
+        tensors = self.graph.get_collection('serving/' + key)
+        if not tensors:
+            return None
+        if len(tensors) == 3:
+            return tf.SparseTensor(*tensors)
+        return tensors[0]
+
+    def feed_dict(self, adj_norm, features, nodes):
+        """Feeds for a normalized adjacency (as a tuple) over the given nodes and their raw features."""
+        features, feature_index, _, _ = model_inputs(features, self.featureless, len(nodes), self.indexed)
+        if self.featureless:
+            feature_index = nodes if self.trained_rows is None else self.trained_rows[nodes]
+        feed_dict = {self.placeholders['adj']: adj_norm}
+        if feature_index is not None:
+            feed_dict[self.placeholders['feature_index']] = feature_index
+        else:
+            feed_dict[self.placeholders['features']] = features
+        return feed_dict
+
+    def forward(self, adj_norm, features, nodes, fetches=None, embeddings=None):
+        """Output logits and embeddings of every node of a (sub)graph.
+
+        Given embeddings are fed in place of the ones the model would compute.
+        """
+        feed_dict = self.feed_dict(adj_norm, features, nodes)
+        if embeddings is not None:
+            feed_dict[self.embeddings] = embeddings
+        return self.sess.run(fetches or [self.outputs, self.embeddings], feed_dict=feed_dict)
+
+    def forward_nodes(self, nodes, hops=None):
+        """Output logits and embeddings of the given nodes, computed on their k-hop subgraph.
+
+        The model runs on the rows and columns of the globally normalized
+        adjacency for the nodes within its receptive field of the query, which
+        gives the outputs of the full forward pass on the current graph at a
+        cost growing with that neighborhood.
+        """
+        adj_norm, features = self.graph_inputs
+        return self._forward_nodes(adj_norm, features, nodes, hops)
+
+    def _forward_nodes(self, adj_norm, features, nodes, hops=None, fetches=None, embeddings=None):
+        nodes = np.asarray(nodes, dtype=np.int64)
+        ball = khop_nodes(adj_norm, nodes, self.receptive_field if hops is None else hops)
+        block = induced_subgraph(adj_norm, ball)
+        results = self.forward(sparse_to_tuple(block), None if features is None else features[ball], ball,
+                               fetches, None if embeddings is None else embeddings[ball])
+        rows = np.searchsorted(ball, nodes)
+        return [result[rows] for result in results]
+
+    def refresh(self):
+        """Recomputes the cached outputs if the graph changed; returns whether it did.
+
+        Nodes and edges added by insert() are dropped when the graph on disk
+        gets a new version.
+        """
+        with self.lock:
+            version = read_manifest(self.graph_dir)['version']
+            if version == self.version:
+                return False
+            adj, features = load_graph(self.graph_dir)[:2]
+            adjacency = NormalizedAdjacency(adj)
+            if self.cache:
+                logits, emb = self.forward(sparse_to_tuple(adjacency.normalized), features, np.arange(adj.shape[0]))
+                self.logits, self.probs, self.emb = logits, softmax(logits), emb
+            self.adjacency = adjacency
+            self.graph_inputs = (adjacency.normalized, features)
+            self.version = version
+            return True
+
+    def insert(self, features=None, edges=None):
+        """Adds nodes and undirected edges to the graph and updates the cached outputs.
+
+        features holds one row per new node (in the format of the saved
+        features); the new nodes get the ids num_nodes, num_nodes + 1, ... and
+        edges, given as (u, v) rows, may refer to them. Only the nodes within
+        the receptive field of the new nodes and edge endpoints are recomputed,
+        on their k-hop subgraph, so the cost grows with the change rather than
+        with the graph. The embeddings are recomputed first and the outputs are
+        then computed from the updated embedding cache, which keeps the
+        subgraphs to run on to the receptive field plus the embedding depth.
+        Returns the ids of the new nodes and of the nodes whose outputs were
+        recomputed.
+        """
+        if not self.cache:
+            raise ValueError('insert updates the cached outputs, the Predictor was created with cache=False')
+        with self.lock:
+            adj_norm, all_features = self.graph_inputs
+            start = adj_norm.shape[0]
+            count = 0
+            if features is not None:
+                if self.featureless:
+                    raise ValueError('Featureless models have no embedding for new nodes')
+                count = features.shape[0] if sp.issparse(features) else len(features)
+            edges = np.asarray(edges if edges is not None else [], dtype=np.int64).reshape(-1, 2)
+            if edges.size and (edges.min() < 0 or edges.max() >= start + count):
+                raise ValueError('Edge endpoint out of range [0, {})'.format(start + count))
+
+            if count:
+                all_features = _append_rows(all_features, features)
+                self.adjacency.add_nodes(count)
+            self.adjacency.update(insertions=edges)
+            adj_norm = self.adjacency.normalized
+
+            def patch(array, nodes, rows):
+                array = np.concatenate((array, np.zeros((count,) + array.shape[1:], dtype=array.dtype)))
+                array[nodes] = rows
+                return array
+
+            new_nodes = np.arange(start, start + count)
+            touched = np.union1d(new_nodes, edges.flatten())
+            updated = khop_nodes(adj_norm, touched, self.receptive_field)
+            if self.embedding_hops is None:
+                logits, emb = self._forward_nodes(adj_norm, all_features, updated)
+                emb = patch(self.emb, updated, emb)
+            else:
+                # embeddings change within embedding_hops of the change, outputs within the receptive field
+                emb_nodes = khop_nodes(adj_norm, touched, self.embedding_hops)
+                emb, = self._forward_nodes(adj_norm, all_features, emb_nodes, self.embedding_hops, [self.embeddings])
+                emb = patch(self.emb, emb_nodes, emb)
+                logits, = self._forward_nodes(adj_norm, all_features, updated,
+                                              self.receptive_field - self.embedding_hops, [self.outputs], emb)
+
+            self.graph_inputs = (adj_norm, all_features)
+            self.logits, self.probs, self.emb = patch(self.logits, updated, logits), \
+                patch(self.probs, updated, softmax(logits)), emb
+            return new_nodes, updated
+
+    def classify(self, nodes):
+        """Predicted class and class probabilities of the given nodes."""
+        probs = self.probs[np.asarray(nodes, dtype=np.int64)]
+        return probs.argmax(1), probs
+
+    def score(self, pairs):
+        """Edge probabilities sigmoid(z_u . z_v) of (u, v) pairs."""
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        emb = self.emb
+        logits = np.sum(emb[pairs[:, 0]] * emb[pairs[:, 1]], axis=1)
+        return 1. / (1. + np.exp(-logits))
+
+    def topk(self, nodes, k=10):
+        """The k highest scoring other nodes of every given node, with their scores."""
+        emb = self.emb
+        nodes = np.asarray(nodes, dtype=np.int64)
+        logits = emb[nodes].dot(emb.T)
+        logits[np.arange(len(nodes)), nodes] = -np.inf
+        k = min(k, emb.shape[0] - 1)
+        top = np.argpartition(-logits, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(logits, top, 1), axis=1)
+        top = np.take_along_axis(top, order, 1)
+        return top, 1. / (1. + np.exp(-np.take_along_axis(logits, top, 1)))
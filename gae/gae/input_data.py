@@ -1,11 +1,17 @@
 import numpy as np
 import pickle as pkl
-import networkx as nx
 import scipy.sparse as sp
 import scipy.io as io
 import sys
+import os
+import json
+import hashlib
+from itertools import islice
 from random import shuffle
 
+MANIFEST = 'manifest.json'
+GRAPH_FORMAT = 1
+
 def parse_index_file(filename):
     index = []
     for line in open(filename):
@@ -16,6 +22,19 @@ def load_protein():
     n = io.loadmat("data/Homo_sapiens.mat")
     return n['network'], n['group']
 
+def adj_from_dict_of_lists(graph, num_nodes):
+    """Build the symmetric, unweighted adjacency of a {node: [neighbors]} dict."""
+    nodes = np.fromiter(graph.keys(), dtype=np.int64, count=len(graph))
+    degrees = np.fromiter((len(graph[node]) for node in nodes), dtype=np.int64, count=len(nodes))
+    rows = np.repeat(nodes, degrees)
+    cols = np.fromiter((v for node in nodes for v in graph[node]), dtype=np.int64, count=degrees.sum())
+    data = np.ones(2 * len(rows))
+    adj = sp.csr_matrix((data, (np.concatenate((rows, cols)), np.concatenate((cols, rows)))),
+                        shape=(num_nodes, num_nodes))
+    # merge duplicate and reverse entries into single unit weights
+    adj.data[:] = 1
+    return adj
+
 def sample_mask(idx, l):
     """Create mask."""
     mask = np.zeros(l)
@@ -26,6 +45,10 @@ def load_data(dataset_str):
     if dataset_str == 'protein':
         return load_protein()
 
+    graph_path = find_graph(dataset_str)
+    if graph_path is not None:
+        return load_graph_data(graph_path)
+
     names = ['x', 'y', 'tx', 'ty', 'allx', 'ally', 'graph']
     objects = []
     for i in range(len(names)):
@@ -47,7 +70,7 @@ def load_data(dataset_str):
 
     features = sp.vstack((allx, tx)).tolil()
     features[test_idx_reorder, :] = features[test_idx_range, :]
-    adj = nx.adjacency_matrix(nx.from_dict_of_lists(graph))
+    adj = adj_from_dict_of_lists(graph, features.shape[0])
 
     labels = np.vstack((ally, ty))
     labels[test_idx_reorder, :] = labels[test_idx_range, :]
@@ -69,3 +92,296 @@ def load_data(dataset_str):
 
     return adj, features, y_train, y_val, y_test, train_mask, val_mask, test_mask
 
+def find_graph(dataset_str):
+    """Return the directory of an on-disk graph named dataset_str, or None."""
+    for path in [dataset_str, os.path.join('data', dataset_str)]:
+        if os.path.isfile(os.path.join(path, MANIFEST)):
+            return path
+    return None
+
+def dataset_files(dataset_str):
+    """Paths of the files load_data(dataset_str) reads."""
+    if dataset_str == 'protein':
+        return ['data/Homo_sapiens.mat']
+    graph_path = find_graph(dataset_str)
+    if graph_path is not None:
+        arrays = read_manifest(graph_path)['arrays']
+        return [os.path.join(graph_path, MANIFEST)] + [os.path.join(graph_path, arrays[key]) for key in sorted(arrays)]
+    return ['data/ind.{}.{}'.format(dataset_str, name) for name in ['x', 'y', 'tx', 'ty', 'allx', 'ally', 'graph', 'test.index']]
+
+def dataset_version(dataset_str):
+    """Digest of the names, sizes and modification times of the files of a dataset."""
+    digest = hashlib.sha1()
+    for path in dataset_files(dataset_str):
+        stat = os.stat(path)
+        digest.update('{} {} {}\n'.format(os.path.basename(path), stat.st_size, int(stat.st_mtime)).encode('utf-8'))
+    return digest.hexdigest()
+
+def _index_dtype(*maxvals):
+    if max(maxvals) < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+def _save_array(path, name, array, dtype=None):
+    array = np.asarray(array, dtype=dtype)
+    np.save(os.path.join(path, name + '.npy'), array)
+    return name + '.npy'
+
+def _write_manifest(path, manifest):
+    tmp = os.path.join(path, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp, os.path.join(path, MANIFEST))
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        manifest = json.load(f)
+    assert manifest['format'] == GRAPH_FORMAT, 'Unsupported graph format: ' + str(manifest['format'])
+    return manifest
+
+def _save_attributes(path, manifest, num_nodes, features, labels, idx_train, idx_val, idx_test, suffix=''):
+    """Write features, labels and splits next to an already written adjacency."""
+    arrays = manifest['arrays']
+    manifest['num_features'] = 0
+    manifest['features'] = None
+    if features is not None:
+        assert features.shape[0] == num_nodes, 'features must have one row per node'
+        manifest['num_features'] = int(features.shape[1])
+        if sp.issparse(features):
+            features = sp.csr_matrix(features)
+            index_dtype = _index_dtype(features.nnz, features.shape[1])
+            arrays['features_indptr'] = _save_array(path, 'features_indptr' + suffix, features.indptr, index_dtype)
+            arrays['features_indices'] = _save_array(path, 'features_indices' + suffix, features.indices, index_dtype)
+            arrays['features_data'] = _save_array(path, 'features_data' + suffix, features.data, np.float32)
+            manifest['features'] = 'csr'
+        else:
+            arrays['features'] = _save_array(path, 'features' + suffix, features, np.float32)
+            manifest['features'] = 'dense'
+
+    manifest['num_classes'] = 0
+    if labels is not None:
+        labels = np.asarray(labels)
+        if labels.ndim == 2:
+            # one-hot rows, all-zero rows are unlabeled
+            manifest['num_classes'] = int(labels.shape[1])
+            labels = np.where(labels.any(1), labels.argmax(1), -1)
+        else:
+            manifest['num_classes'] = int(labels.max()) + 1
+        assert labels.shape[0] == num_nodes, 'labels must have one entry per node'
+        arrays['labels'] = _save_array(path, 'labels' + suffix, labels, np.int32)
+
+    for name, idx in [('idx_train', idx_train), ('idx_val', idx_val), ('idx_test', idx_test)]:
+        if idx is not None:
+            arrays[name] = _save_array(path, name + suffix, idx, np.int64)
+
+def save_graph(path, adj, features=None, labels=None, idx_train=None, idx_val=None, idx_test=None, name=None):
+    """Write a graph in the memory-mapped on-disk format.
+
+    The adjacency (and sparse features) are stored as CSR indptr/indices/data
+    arrays, each in its own .npy file, described by a JSON manifest.
+    Labels are stored as class ids (-1 for unlabeled nodes).
+
+    Saving over an existing graph writes a new version: the arrays go to new
+    files and the manifest is switched over atomically, so readers that still
+    map the previous version are not affected, and its files are removed.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    previous = read_manifest(path) if os.path.exists(os.path.join(path, MANIFEST)) else None
+    version = previous['version'] + 1 if previous else 0
+    suffix = '.v{}'.format(version) if version else ''
+
+    adj = sp.csr_matrix(adj)
+    adj.sum_duplicates()
+    num_nodes = adj.shape[0]
+    index_dtype = _index_dtype(adj.nnz, num_nodes)
+
+    manifest = {'format': GRAPH_FORMAT, 'name': name or os.path.basename(os.path.normpath(path)),
+                'num_nodes': int(num_nodes), 'num_edges': int(adj.nnz), 'version': version, 'arrays': {}}
+    arrays = manifest['arrays']
+    arrays['adj_indptr'] = _save_array(path, 'adj_indptr' + suffix, adj.indptr, index_dtype)
+    arrays['adj_indices'] = _save_array(path, 'adj_indices' + suffix, adj.indices, index_dtype)
+    arrays['adj_data'] = _save_array(path, 'adj_data' + suffix, adj.data, np.float32)
+    _save_attributes(path, manifest, num_nodes, features, labels, idx_train, idx_val, idx_test, suffix)
+    _write_manifest(path, manifest)
+
+    if previous:
+        for filename in set(previous['arrays'].values()) - set(arrays.values()):
+            os.remove(os.path.join(path, filename))
+    return manifest
+
+def export_data(dataset_str, path):
+    """Convert a dataset understood by load_data into the on-disk format."""
+    adj, features, y_train, y_val, y_test, train_mask, val_mask, test_mask = load_data(dataset_str)
+    labels = y_train + y_val + y_test
+    return save_graph(path, adj, features, labels, np.where(train_mask)[0], np.where(val_mask)[0],
+                      np.where(test_mask)[0], name=dataset_str)
+
+def _read_edge_chunks(edge_file, chunk_size, delimiter):
+    with open(edge_file) as f:
+        lines = (line for line in f if line.strip() and not line.lstrip().startswith('#'))
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                break
+            edges = np.loadtxt(chunk, delimiter=delimiter, ndmin=2)
+            u = edges[:, 0].astype(np.int64)
+            v = edges[:, 1].astype(np.int64)
+            w = edges[:, 2] if edges.shape[1] > 2 else np.ones(len(u))
+            yield u, v, w
+
+def _edge_chunks(edge_file, chunk_size, delimiter, symmetric, self_loops):
+    for u, v, w in _read_edge_chunks(edge_file, chunk_size, delimiter):
+        if not self_loops:
+            keep = u != v
+            u, v, w = u[keep], v[keep], w[keep]
+        if symmetric:
+            # each edge is followed by its reverse, so both directions of a pair see its weights in the same order
+            u, v, w = np.column_stack((u, v)).ravel(), np.column_stack((v, u)).ravel(), np.repeat(w, 2)
+        yield u, v, w
+
+def convert_edge_list(edge_file, path, num_nodes=None, features=None, labels=None, idx_train=None,
+                      idx_val=None, idx_test=None, symmetric=True, self_loops=False, delimiter=None,
+                      chunk_size=1000000, name=None):
+    """Import a whitespace separated "u v [weight]" edge list into the on-disk format.
+
+    The edge list is streamed in chunks of chunk_size lines and the CSR arrays are
+    filled through memory maps, so the graph never has to fit in memory. Duplicate
+    edges are merged, keeping the first weight seen; with symmetric, "u v" and
+    "v u" are the same edge, so both directions get the weight of the line that
+    lists it first. Converting into an existing graph writes a new version, as
+    save_graph does.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    previous = read_manifest(path) if os.path.exists(os.path.join(path, MANIFEST)) else None
+    version = previous['version'] + 1 if previous else 0
+    suffix = '.v{}'.format(version) if version else ''
+
+    # First pass: row counts
+    counts = np.zeros(num_nodes or 0, dtype=np.int64)
+    for u, v, w in _edge_chunks(edge_file, chunk_size, delimiter, symmetric, self_loops):
+        if len(u) == 0:
+            continue
+        n = max(u.max(), v.max()) + 1
+        if num_nodes is not None:
+            assert n <= num_nodes, 'edge list references node ' + str(n - 1)
+        elif n > len(counts):
+            counts = np.concatenate((counts, np.zeros(n - len(counts), dtype=np.int64)))
+        counts += np.bincount(u, minlength=len(counts))
+    num_nodes = len(counts)
+    indptr = np.concatenate(([0], np.cumsum(counts)))
+    nnz = int(indptr[-1])
+    index_dtype = _index_dtype(nnz, num_nodes)
+
+    # Second pass: scatter every entry into its row
+    tmp_indices_file = os.path.join(path, 'adj_indices.tmp.npy')
+    tmp_data_file = os.path.join(path, 'adj_data.tmp.npy')
+    indices = np.lib.format.open_memmap(tmp_indices_file, mode='w+', dtype=index_dtype, shape=(nnz,))
+    data = np.lib.format.open_memmap(tmp_data_file, mode='w+', dtype=np.float32, shape=(nnz,))
+    cursor = indptr[:-1].copy()
+    for u, v, w in _edge_chunks(edge_file, chunk_size, delimiter, symmetric, self_loops):
+        order = np.argsort(u, kind='mergesort')
+        u, v, w = u[order], v[order], w[order]
+        starts = np.searchsorted(u, u)
+        pos = cursor[u] + np.arange(len(u)) - starts
+        indices[pos] = v
+        data[pos] = w
+        cursor += np.bincount(u, minlength=num_nodes)
+
+    # Third pass: sort every row by column and merge duplicates, compacting in place
+    new_indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    write = 0
+    start = 0
+    while start < num_nodes:
+        stop = max(np.searchsorted(indptr, indptr[start] + chunk_size, side='right') - 1, start + 1)
+        stop = min(stop, num_nodes)
+        lo, hi = indptr[start], indptr[stop]
+        rows = np.repeat(np.arange(start, stop), np.diff(indptr[start:stop + 1]))
+        cols = np.array(indices[lo:hi])
+        vals = np.array(data[lo:hi])
+        order = np.lexsort((cols, rows))
+        rows, cols, vals = rows[order], cols[order], vals[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+        indices[write:write + len(cols)] = cols
+        data[write:write + len(vals)] = vals
+        write += len(cols)
+        new_indptr[start + 1:stop + 1] = np.cumsum(np.bincount(rows - start, minlength=stop - start)) + new_indptr[start]
+        start = stop
+    nnz = write
+
+    manifest = {'format': GRAPH_FORMAT, 'name': name or os.path.basename(os.path.normpath(path)),
+                'num_nodes': int(num_nodes), 'num_edges': nnz, 'version': version, 'arrays': {}}
+    arrays = manifest['arrays']
+    arrays['adj_indptr'] = _save_array(path, 'adj_indptr' + suffix, new_indptr, index_dtype)
+    for array_name, tmp, dtype in [('adj_indices', indices, index_dtype), ('adj_data', data, np.float32)]:
+        filename = array_name + suffix + '.npy'
+        out = np.lib.format.open_memmap(os.path.join(path, filename), mode='w+', dtype=dtype, shape=(nnz,))
+        for lo in range(0, nnz, chunk_size):
+            out[lo:lo + chunk_size] = tmp[lo:min(lo + chunk_size, nnz)]
+        out.flush()
+        arrays[array_name] = filename
+        del out
+    del indices, data
+    os.remove(tmp_indices_file)
+    os.remove(tmp_data_file)
+
+    _save_attributes(path, manifest, num_nodes, features, labels, idx_train, idx_val, idx_test, suffix)
+    _write_manifest(path, manifest)
+
+    if previous:
+        for filename in set(previous['arrays'].values()) - set(arrays.values()):
+            os.remove(os.path.join(path, filename))
+    return manifest
+
+def load_graph(path):
+    """Open a graph written by save_graph or convert_edge_list.
+
+    All arrays are opened with np.load(mmap_mode='r'), so only the rows that are
+    actually touched get paged in. Returns adj, features, labels, idx_train,
+    idx_val, idx_test; missing entries are None.
+    """
+    manifest = read_manifest(path)
+    arrays = manifest['arrays']
+    num_nodes = manifest['num_nodes']
+
+    def mmap(key):
+        if key not in arrays:
+            return None
+        return np.load(os.path.join(path, arrays[key]), mmap_mode='r')
+
+    adj = sp.csr_matrix((mmap('adj_data'), mmap('adj_indices'), mmap('adj_indptr')),
+                        shape=(num_nodes, num_nodes), copy=False)
+    features = None
+    if manifest['features'] == 'csr':
+        features = sp.csr_matrix((mmap('features_data'), mmap('features_indices'), mmap('features_indptr')),
+                                 shape=(num_nodes, manifest['num_features']), copy=False)
+    elif manifest['features'] == 'dense':
+        features = mmap('features')
+    return adj, features, mmap('labels'), mmap('idx_train'), mmap('idx_val'), mmap('idx_test')
+
+def load_graph_data(path):
+    """load_data counterpart for the on-disk format."""
+    manifest = read_manifest(path)
+    adj, features, labels, idx_train, idx_val, idx_test = load_graph(path)
+    num_nodes = manifest['num_nodes']
+    if features is None:
+        features = sp.identity(num_nodes, format='csr')
+
+    labels_onehot = np.zeros((num_nodes, max(manifest['num_classes'], 1)))
+    if labels is not None:
+        labeled = np.where(labels >= 0)[0]
+        labels_onehot[labeled, labels[labeled]] = 1
+
+    masks = []
+    ys = []
+    for idx in [idx_train, idx_val, idx_test]:
+        mask = sample_mask(idx if idx is not None else [], num_nodes)
+        y = np.zeros(labels_onehot.shape)
+        y[mask, :] = labels_onehot[mask, :]
+        masks.append(mask)
+        ys.append(y)
+
+    return adj, features, ys[0], ys[1], ys[2], masks[0], masks[1], masks[2]
@@ -1,4 +1,5 @@
 from gae.initializations import *
+import contextlib
 import tensorflow as tf
 
 flags = tf.app.flags
@@ -17,16 +18,116 @@ def get_layer_uid(layer_name=''):
         _LAYER_UIDS[layer_name] += 1
         return _LAYER_UIDS[layer_name]
 
-def dropout_sparse(x, keep_prob, num_nonzero_elems):
-    """Dropout for sparse tensors. Currently fails for very large sparse tensors (>1M elements)
+def dropout_sparse(x, keep_prob, num_nonzero_elems=None, keep_pattern=True):
+    """Dropout for sparse tensors.
+
+    The mask is sized from x.values at run time, num_nonzero_elems is ignored and
+    only kept for existing callers. By default dropped values are zeroed in place
+    and the indices are left untouched, which avoids the index copy and gather of
+    tf.sparse_retain on very large inputs; keep_pattern=False removes them instead.
     """
-    noise_shape = [num_nonzero_elems]
+    if isinstance(keep_prob, (int, float)) and keep_prob == 1.:
+        return x
     random_tensor = keep_prob
-    random_tensor += tf.random_uniform(noise_shape)
-    dropout_mask = tf.cast(tf.floor(random_tensor), dtype=tf.bool)
-    pre_out = tf.sparse_retain(x, dropout_mask)
+    random_tensor += tf.random_uniform(tf.shape(x.values))
+    dropout_mask = tf.floor(random_tensor)
+    if keep_pattern:
+        return tf.SparseTensor(x.indices, x.values * dropout_mask * (1./keep_prob), x.dense_shape)
+    pre_out = tf.sparse_retain(x, tf.cast(dropout_mask, dtype=tf.bool))
     return pre_out * (1./keep_prob)
 
+def lookup_weights(weights, feature_index, keep_prob):
+    """X W for one-hot inputs X given as the column index of every row.
+
+    Gathers the weight rows directly; dropping the single nonzero of a row is the
+    same as dropping the whole gathered row.
+    """
+    x = tf.gather(weights, feature_index)
+    return tf.nn.dropout(x, keep_prob, noise_shape=[tf.shape(x)[0], 1])
+
+@contextlib.contextmanager
+def _no_scope():
+    yield
+
+def xla_scope(enabled=True):
+    """Marks the ops built inside (and their gradients) for XLA JIT compilation.
+
+    Only dense computations should be built in this scope; sparse ops have no XLA
+    kernels and are kept out of the compiled clusters by building them outside.
+    A no-op context when enabled is false.
+    """
+    if not enabled:
+        return _no_scope()
+    return tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=True, separate_compiled_gradients=True)
+
+@tf.custom_gradient
+def _dense_gradient(x):
+    """Identity whose gradient is made dense (e.g. the row gradients of a gather)."""
+    return tf.identity(x), lambda dy: tf.convert_to_tensor(dy)
+
+def recompute(fn, layers):
+    """Wraps fn so that its activations are recomputed in the backward pass instead of kept.
+
+    fn may only use the weights of `layers`: they are passed to the recomputed
+    function as tensors and rebound in layer.vars while it runs. Floating point
+    tensor arguments are passed through as well, other arguments (sparse inputs,
+    feature indices) are closed over. fn must be deterministic, i.e. without
+    dropout or sampling, or the recomputed activations would differ.
+    """
+    keys = [(layer, key) for layer in layers for key in sorted(layer.vars)
+            if isinstance(layer.vars[key], (tf.Tensor, tf.Variable))]
+
+    def wrapped(*inputs):
+        dense = [i for i, x in enumerate(inputs) if isinstance(x, tf.Tensor) and x.dtype.is_floating]
+
+        def call(*args):
+            x = list(inputs)
+            for i, arg in zip(dense, args):
+                x[i] = arg
+            saved = [layer.vars[key] for layer, key in keys]
+            for (layer, key), w in zip(keys, args[len(dense):]):
+                layer.vars[key] = w
+            try:
+                return fn(*x)
+            finally:
+                for (layer, key), w in zip(keys, saved):
+                    layer.vars[key] = w
+
+        weights = [tf.convert_to_tensor(layer.vars[key]) for layer, key in keys]
+        outputs = tf.contrib.layers.recompute_grad(call)(*([inputs[i] for i in dense] + weights))
+        # the recomputation takes the output gradients as dense tensors
+        if isinstance(outputs, (list, tuple)):
+            return tuple(_dense_gradient(x) for x in outputs)
+        return _dense_gradient(outputs)
+    return wrapped
+
+def dot(x, weights):
+    """x weights, where x may carry a leading sample axis ([samples, nodes, dim])."""
+    if x.shape.ndims != 3:
+        return tf.matmul(x, weights)
+    shape = tf.shape(x)
+    x = tf.matmul(tf.reshape(x, [-1, shape[2]]), weights)
+    return tf.reshape(x, [shape[0], shape[1], weights.get_shape().as_list()[1]])
+
+def spmm(adj, x):
+    """adj x for a sparse adjacency, applied to every sample of a [samples, nodes, dim] x."""
+    if x.shape.ndims != 3:
+        return tf.sparse_tensor_dense_matmul(adj, x)
+    shape = tf.shape(x)
+    dim = x.get_shape().as_list()[2] or shape[2]
+    # stack the samples along the columns for a single product
+    x = tf.reshape(tf.transpose(x, [1, 0, 2]), [shape[1], -1])
+    x = tf.sparse_tensor_dense_matmul(adj, x)
+    return tf.transpose(tf.reshape(x, [-1, shape[0], dim]), [1, 0, 2])
+
+def broadcast_samples(xs):
+    """Tiles the [nodes, dim] tensors of xs along the sample axis of the others, if any has one."""
+    batched = [x for x in xs if x.shape.ndims == 3]
+    if not batched:
+        return list(xs)
+    num_samples = tf.shape(batched[0])[0]
+    return [x if x.shape.ndims == 3 else tf.tile(tf.expand_dims(x, 0), [num_samples, 1, 1]) for x in xs]
+
 def zeros(shape, name=None):
     """All zeros."""
     initial = tf.zeros(shape, dtype=tf.float32)
@@ -37,6 +138,9 @@ class Layer(object):
 
     # Properties
         name: String, defines the variable scope of the layer.
+        memoize: Boolean, calls on an input already seen return the outputs
+            built for it instead of adding the computation again (dropout
+            masks are then shared between those calls).
 
     # Methods
         _call(inputs): Defines computation graph of layer
@@ -44,7 +148,7 @@ class Layer(object):
         __call__(inputs): Wrapper for _call()
     """
     def __init__(self, **kwargs):
-        allowed_kwargs = {'name', 'logging'}
+        allowed_kwargs = {'name', 'logging', 'memoize'}
         for kwarg in kwargs.keys():
             assert kwarg in allowed_kwargs, 'Invalid keyword argument: ' + kwarg
         name = kwargs.get('name')
@@ -56,14 +160,22 @@ class Layer(object):
         logging = kwargs.get('logging', False)
         self.logging = logging
         self.issparse = False
+        self.memoize = kwargs.get('memoize', False)
+        self._memo = []
 
     def _call(self, inputs):
         return inputs
 
     def __call__(self, inputs):
+        if self.memoize:
+            for seen, outputs in self._memo:
+                if seen is inputs:
+                    return outputs
         with tf.name_scope(self.name):
             outputs = self._call(inputs)
-            return outputs
+        if self.memoize:
+            self._memo.append((inputs, outputs))
+        return outputs
 
 class Dense(Layer):
     """Dense layer."""
@@ -91,12 +203,14 @@ class Dense(Layer):
     def _call(self, inputs):
         x = inputs
 
-        if self.sparse_inputs:
+        if self.featureless:
+            output = lookup_weights(self.vars['weights'], x, 1-self.dropout)
+        elif self.sparse_inputs:
             x = dropout_sparse(x, 1-self.dropout, self.features_nonzero)
             output = tf.sparse_tensor_dense_matmul(x, self.vars['weights'])
         else:
             x = tf.nn.dropout(x, 1-self.dropout)
-            output = tf.matmul(x, self.vars['weights'])
+            output = dot(x, self.vars['weights'])
 
         # bias
         if self.bias:
@@ -106,7 +220,8 @@ class Dense(Layer):
 
 class GraphConvolutionDense(Layer):
     """Basic graph convolution layer for undirected graph without edge labels."""
-    def __init__(self, input_dim, output_dim, sparse_inputs = False, features_nonzero=-1, dropout=0., act=tf.nn.relu, **kwargs):
+    def __init__(self, input_dim, output_dim, sparse_inputs = False, features_nonzero=-1, dropout=0., act=tf.nn.relu,
+                 featureless=False, **kwargs):
         super(GraphConvolutionDense, self).__init__(**kwargs)
         with tf.variable_scope(self.name + '_vars'):
             self.vars['weights'] = weight_variable_glorot(input_dim, output_dim, name="weights")
@@ -114,20 +229,25 @@ class GraphConvolutionDense(Layer):
         self.act = act
         self.sparse_inputs = sparse_inputs
         self.features_nonzero = features_nonzero
+        self.featureless = featureless
 
-    def _call(self, inputs):
-        x = inputs[0]
-        recon_1 = inputs[1]
-        recon_2 = inputs[2]
-        if self.sparse_inputs:
+    def _transform(self, x):
+        if self.featureless:
+            return lookup_weights(self.vars['weights'], x, 1-self.dropout)
+        elif self.sparse_inputs:
             x = dropout_sparse(x, 1-self.dropout, self.features_nonzero)
-            x = tf.sparse_tensor_dense_matmul(x, self.vars['weights'])
-        else:
-            x = tf.nn.dropout(x, 1-self.dropout)
-            x = tf.matmul(x, self.vars['weights'])
-        x = tf.matmul(recon_1, tf.matmul(tf.transpose(recon_1), x)) + tf.matmul(recon_2, tf.matmul(tf.transpose(recon_2), x))
-        outputs = self.act(x)
-        return outputs
+            return tf.sparse_tensor_dense_matmul(x, self.vars['weights'])
+        x = tf.nn.dropout(x, 1-self.dropout)
+        return dot(x, self.vars['weights'])
+
+    def _propagate(self, x, recon_1, recon_2):
+        x = broadcast_samples([x, recon_1])[0]
+        x = tf.matmul(recon_1, tf.matmul(tf.matrix_transpose(recon_1), x)) + tf.matmul(recon_2, tf.matmul(tf.matrix_transpose(recon_2), x))
+        return self.act(x)
+
+    def _call(self, inputs):
+        x = self._transform(inputs[0])
+        return self._propagate(x, inputs[1], inputs[2])
 
 class GraphConvolution(Layer):
     """Basic graph convolution layer for undirected graph without edge labels."""
@@ -139,22 +259,27 @@ class GraphConvolution(Layer):
         self.adj = adj
         self.act = act
 
-    def _call(self, inputs):
+    def _transform(self, inputs):
         x = inputs
         x = tf.nn.dropout(x, 1-self.dropout)
-        x = tf.matmul(x, self.vars['weights'])
-        x = tf.sparse_tensor_dense_matmul(self.adj, x)
+        return dot(x, self.vars['weights'])
+
+    def _call(self, inputs):
+        x = self._transform(inputs)
+        x = spmm(self.adj, x)
         outputs = self.act(x)
         return outputs
 
 class MultiGraphAttention(Layer):
-    def __init__(self, input_dim, output_dim, num_head, adj, features_nonzero, sparse=True, dropout=0., concat=True, act=tf.nn.relu, **kwargs):
+    def __init__(self, input_dim, output_dim, num_head, adj, features_nonzero, sparse=True, dropout=0., concat=True, act=tf.nn.relu,
+                 featureless=False, **kwargs):
         super(MultiGraphAttention, self).__init__(**kwargs)
         with tf.variable_scope(self.name + '_vars'):
             weight_l2 = 0.
             for i in range(num_head):
                 name = 'l' + str(i)
-                self.vars[name] = GraphAttention(input_dim, output_dim, adj, features_nonzero, sparse, dropout, act)
+                self.vars[name] = GraphAttention(input_dim, output_dim, adj, features_nonzero, sparse, dropout, act,
+                                                 featureless=featureless)
                 weight_l2 += tf.nn.l2_loss(self.vars[name].vars['weights'])
                 weight_l2 += tf.nn.l2_loss(self.vars[name].vars['a1'])
                 weight_l2 += tf.nn.l2_loss(self.vars[name].vars['a2'])
@@ -174,7 +299,8 @@ class MultiGraphAttention(Layer):
             return tf.add_n(output_list) / len(output_list)
 
 class GraphAttention(Layer):
-    def __init__(self, input_dim, output_dim, adj, features_nonzero, sparse=True, dropout=0., act=tf.nn.relu, **kwargs):
+    def __init__(self, input_dim, output_dim, adj, features_nonzero, sparse=True, dropout=0., act=tf.nn.relu,
+                 featureless=False, **kwargs):
         super(GraphAttention, self).__init__(**kwargs)
         with tf.variable_scope(self.name + '_vars'):
             self.vars['weights'] = weight_variable_glorot(input_dim, output_dim, name="weights")
@@ -186,10 +312,13 @@ class GraphAttention(Layer):
         self.act = act
         self.features_nonzero = features_nonzero
         self.sparse = sparse
+        self.featureless = featureless
 
     def _call(self, inputs):
         x = inputs
-        if self.sparse:
+        if self.featureless:
+            x = lookup_weights(self.vars['weights'], x, 1-self.dropout)
+        elif self.sparse:
             x = dropout_sparse(x, 1-self.dropout, self.features_nonzero)
             x = tf.sparse_tensor_dense_matmul(x, self.vars['weights'])
         else:
@@ -229,7 +358,7 @@ class GraphAttention(Layer):
 
 class GraphConvolutionSparse(Layer):
     """Graph convolution layer for sparse inputs."""
-    def __init__(self, input_dim, output_dim, adj, features_nonzero, dropout=0., act=tf.nn.relu, **kwargs):
+    def __init__(self, input_dim, output_dim, adj, features_nonzero, dropout=0., act=tf.nn.relu, featureless=False, **kwargs):
         super(GraphConvolutionSparse, self).__init__(**kwargs)
         with tf.variable_scope(self.name + '_vars'):
             self.vars['weights'] = weight_variable_glorot(input_dim, output_dim, name="weights")
@@ -238,15 +367,57 @@ class GraphConvolutionSparse(Layer):
         self.act = act
         self.issparse = True
         self.features_nonzero = features_nonzero
+        self.featureless = featureless
 
-    def _call(self, inputs):
+    def _transform(self, inputs):
         x = inputs
+        if self.featureless:
+            return lookup_weights(self.vars['weights'], x, 1-self.dropout)
         x = dropout_sparse(x, 1-self.dropout, self.features_nonzero)
-        x = tf.sparse_tensor_dense_matmul(x, self.vars['weights'])
+        return tf.sparse_tensor_dense_matmul(x, self.vars['weights'])
+
+    def _call(self, inputs):
+        x = self._transform(inputs)
         x = tf.sparse_tensor_dense_matmul(self.adj, x)
         outputs = self.act(x)
         return outputs
 
+class FusedGraphConvolution(Layer):
+    """Several graph convolutions over the same adjacency sharing one SpMM.
+
+    Takes existing GraphConvolution / GraphConvolutionSparse layers, which keep
+    their own variables, and one input per layer. The per-layer products are
+    concatenated, multiplied by the adjacency once and split again (or returned
+    concatenated when concat is set). Dense inputs shared by all layers without
+    dropout also share a single matmul against the concatenated weights.
+    """
+    def __init__(self, layers, concat=False, **kwargs):
+        super(FusedGraphConvolution, self).__init__(**kwargs)
+        self.layers = layers
+        self.adj = layers[0].adj
+        self.concat = concat
+        self.output_dims = [layer.vars['weights'].get_shape().as_list()[1] for layer in layers]
+
+    def _shared_input(self, inputs):
+        return all(x is inputs[0] for x in inputs) and \
+            all(not layer.issparse and isinstance(layer.dropout, (int, float)) and layer.dropout == 0.
+                for layer in self.layers)
+
+    def _call(self, inputs):
+        if self._shared_input(inputs):
+            weights = tf.concat([layer.vars['weights'] for layer in self.layers], 1)
+            x = dot(inputs[0], weights)
+        else:
+            x = tf.concat(broadcast_samples([layer._transform(x) for layer, x in zip(self.layers, inputs)]), -1)
+        x = spmm(self.adj, x)
+
+        if self.concat and all(layer.act is self.layers[0].act for layer in self.layers):
+            return self.layers[0].act(x)
+        outputs = [layer.act(x) for layer, x in zip(self.layers, tf.split(x, self.output_dims, axis=-1))]
+        if self.concat:
+            return tf.concat(outputs, -1)
+        return outputs
+
 class ScaledInnerProductDecoder(Layer):
     def __init__(self, input_dim, dropout=0., act=tf.nn.sigmoid, **kwargs):
         super(ScaledInnerProductDecoder, self).__init__(**kwargs)
@@ -33,6 +33,23 @@ class Model(object):
         variables = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=self.name)
         self.vars = {var.name: var for var in variables}
 
+    def input_graph_convolution(self, output_dim, act, dropout, **kwargs):
+        """Graph convolution on the model inputs, matching their format."""
+        if self.sparse_inputs or self.featureless:
+            return GraphConvolutionSparse(input_dim=self.input_dim, output_dim=output_dim, adj=self.adj,
+                                          features_nonzero=self.features_nonzero, featureless=self.featureless,
+                                          act=act, dropout=dropout, logging=self.logging, **kwargs)
+        return GraphConvolution(input_dim=self.input_dim, output_dim=output_dim, adj=self.adj,
+                                act=act, dropout=dropout, logging=self.logging, **kwargs)
+
+    def export_tensors(self):
+        """Per-node tensors saved with the model for inference (see inference.Exporter)."""
+        return {'outputs': self.outputs, 'embeddings': self.embeddings}
+
+    def dense_scope(self):
+        """XLA JIT scope for the dense parts of the model (see --xla)."""
+        return xla_scope(FLAGS.xla)
+
     def fit(self):
         pass
 
@@ -43,7 +60,10 @@ class GCNModel(Model):
     def __init__(self, placeholders, num_features, num_nodes, features_nonzero, **kwargs):
         super(GCNModel, self).__init__(**kwargs)
 
-        self.inputs = placeholders['features']
+        # featureless / one-hot inputs are given as one column index per node
+        self.featureless = 'feature_index' in placeholders
+        self.inputs = placeholders['feature_index'] if self.featureless else placeholders['features']
+        self.sparse_inputs = isinstance(self.inputs, tf.SparseTensor)
         self.input_dim = num_features
         self.output_dim = placeholders['labels'].get_shape().as_list()[1]
         self.features_nonzero = features_nonzero
@@ -62,13 +82,9 @@ class GCNModel(Model):
         inputs = self.inputs
 
         if not FLAGS.attention:
-          hidden = GraphConvolutionSparse(input_dim=self.input_dim,
-                                                output_dim=FLAGS.hidden_y,
-                                                adj=self.adj,
+          hidden = self.input_graph_convolution(output_dim=FLAGS.hidden_y,
                                                 act=tf.nn.relu,
-                                                features_nonzero=self.features_nonzero,
-                                                dropout=self.dropout,
-                                                logging=self.logging)
+                                                dropout=self.dropout)
 
           output = GraphConvolution(input_dim=FLAGS.hidden_y,
                                          output_dim=self.output_dim,
@@ -83,6 +99,8 @@ class GCNModel(Model):
                                                 adj=self.adj,
                                                 act=tf.nn.elu,
                                                 features_nonzero=self.features_nonzero,
+                                                featureless=self.featureless,
+                                                sparse=self.sparse_inputs,
                                                 num_head = FLAGS.num_head,
                                                 dropout=self.dropout,
                                                 logging=self.logging)
@@ -98,13 +116,81 @@ class GCNModel(Model):
                                          logging=self.logging)
           self.weight_norm = FLAGS.weight_decay * hidden.vars['weight_l2']
 
-        self.outputs = output(hidden(inputs))
+        self.embeddings = hidden(inputs)
+        # propagation steps from the inputs to the embeddings
+        self.embedding_hops = 1
+        self.outputs = output(self.embeddings)
+
+class MLPModel(Model):
+    """Graph-free student of a trained model (see distill.py): Dense layers on the node features.
+
+    Optional positional features (placeholders['positions'], dense) get their
+    own first layer, added to the one of the features before the activation.
+    """
+    def __init__(self, placeholders, num_features, features_nonzero, hidden_dims, **kwargs):
+        super(MLPModel, self).__init__(**kwargs)
+
+        self.featureless = 'feature_index' in placeholders
+        self.inputs = placeholders['feature_index'] if self.featureless else placeholders['features']
+        self.sparse_inputs = isinstance(self.inputs, tf.SparseTensor)
+        self.positions = placeholders.get('positions')
+        self.input_dim = num_features
+        self.output_dim = placeholders['labels'].get_shape().as_list()[1]
+        self.features_nonzero = features_nonzero
+        self.hidden_dims = list(hidden_dims)
+        self.dropout = placeholders['dropout']
+        self.labels = placeholders['labels']
+        self.labels_mask = placeholders['labels_mask']
+        self.weight_norm = 0
+        self.build()
+
+    def _build(self):
+        dims = self.hidden_dims + [self.output_dim]
+        first_act = tf.nn.relu if self.hidden_dims else (lambda x: x)
+        input_layer = Dense(input_dim=self.input_dim,
+                            output_dim=dims[0],
+                            dropout=self.dropout,
+                            sparse_inputs=self.sparse_inputs,
+                            featureless=self.featureless,
+                            features_nonzero=self.features_nonzero,
+                            act=lambda x: x,
+                            bias=True,
+                            logging=self.logging)
+        hidden = input_layer(self.inputs)
+        self.weight_norm = FLAGS.weight_decay * tf.nn.l2_loss(input_layer.vars['weights'])
+        if self.positions is not None:
+            position_layer = Dense(input_dim=self.positions.get_shape().as_list()[1],
+                                   output_dim=dims[0],
+                                   dropout=self.dropout,
+                                   act=lambda x: x,
+                                   logging=self.logging)
+            hidden += position_layer(self.positions)
+            self.weight_norm += FLAGS.weight_decay * tf.nn.l2_loss(position_layer.vars['weights'])
+        hidden = first_act(hidden)
+
+        self.embeddings = hidden
+        for i, dim in enumerate(dims[1:]):
+            last = i == len(dims) - 2
+            hidden = Dense(input_dim=dims[i],
+                           output_dim=dim,
+                           dropout=self.dropout,
+                           act=(lambda x: x) if last else tf.nn.relu,
+                           bias=True,
+                           logging=self.logging)(hidden)
+            if not last:
+                self.embeddings = hidden
+        # no propagation: every node only depends on its own inputs
+        self.embedding_hops = 0
+        self.outputs = hidden
 
 class GCNModelFeedback(Model):
     def __init__(self, placeholders, num_features, num_nodes, features_nonzero, **kwargs):
         super(GCNModelFeedback, self).__init__(**kwargs)
 
-        self.inputs = placeholders['features']
+        # featureless / one-hot inputs are given as one column index per node
+        self.featureless = 'feature_index' in placeholders
+        self.inputs = placeholders['feature_index'] if self.featureless else placeholders['features']
+        self.sparse_inputs = isinstance(self.inputs, tf.SparseTensor)
         self.input_dim = num_features
         self.output_dim = placeholders['labels'].get_shape().as_list()[1]
         self.features_nonzero = features_nonzero
@@ -117,8 +203,12 @@ class GCNModelFeedback(Model):
         self.weight_norm = 0
         self.build()
 
-    def sample(self, mean, log_std, dim):
-        return mean + tf.random_normal([self.n_samples, dim]) * tf.exp(log_std)
+    def sample(self, mean, log_std, dim, num_samples=1):
+        """Reparameterized sample; num_samples > 1 stacks that many along a new leading axis."""
+        shape = tf.shape(mean)
+        if num_samples > 1:
+          shape = tf.concat([[num_samples], shape], 0)
+        return mean + tf.random_normal(shape) * tf.exp(log_std)
 
     def reconstruct_graph(self, emb, normalize = True):
         embT = tf.transpose(emb)
@@ -135,14 +225,12 @@ class GCNModelFeedback(Model):
         return graph
 
     def define_layers(self):
+        if FLAGS.attention and FLAGS.num_samples > 1:
+          raise ValueError('--num_samples > 1 is not supported with --attention')
 
-        self.hidden_z1q_layer = GraphConvolutionSparse(input_dim=self.input_dim,
-                                              output_dim=FLAGS.hidden_z1q,
-                                              adj=self.adj,
-                                              features_nonzero=self.features_nonzero,
+        self.hidden_z1q_layer = self.input_graph_convolution(output_dim=FLAGS.hidden_z1q,
                                               act=tf.nn.relu,
-                                              dropout=0.,
-                                              logging=self.logging)
+                                              dropout=0.)
 
         self.z1q_mean_layer = GraphConvolution(input_dim=FLAGS.hidden_z1q,
                                        output_dim=FLAGS.dim_z1,
@@ -158,17 +246,21 @@ class GCNModelFeedback(Model):
                                           dropout=0.,
                                           logging=self.logging)
 
+        self.z1q_layer = None
+        if FLAGS.fused_spmm:
+          self.z1q_layer = FusedGraphConvolution([self.z1q_mean_layer, self.z1q_log_std_layer],
+                                                 logging=self.logging)
+
+        self.hidden_y_layer = None
+
         if not FLAGS.attention:
           activation = tf.nn.relu
           if FLAGS.mute_relu:
             activation = tf.identity
-          self.hidden_y_layer_x = GraphConvolutionSparse(input_dim=self.input_dim,
-                                                output_dim=FLAGS.hidden_y,
-                                                adj=self.adj,
-                                                features_nonzero=self.features_nonzero,
+          self.hidden_y_layer_x = self.input_graph_convolution(output_dim=FLAGS.hidden_y,
                                                 act=activation,
                                                 dropout=self.dropout,
-                                                logging=self.logging)
+                                                memoize=bool(FLAGS.share_input_branch))
 
           self.hidden_y_layer_z1 = GraphConvolution(input_dim=FLAGS.dim_z1,
                                          output_dim=FLAGS.hidden_y,
@@ -185,14 +277,23 @@ class GCNModelFeedback(Model):
                                          logging=self.logging)
           self.weight_norm += FLAGS.weight_decay * tf.nn.l2_loss(self.hidden_y_layer_x.vars['weights'])
           self.weight_norm += FLAGS.z1_decay * tf.nn.l2_loss(self.hidden_y_layer_z1.vars['weights'])
+
+          # with a shared input branch only the z1 branch is left to run twice
+          if FLAGS.fused_spmm and not FLAGS.share_input_branch:
+            self.hidden_y_layer = FusedGraphConvolution([self.hidden_y_layer_x, self.hidden_y_layer_z1],
+                                                        concat=True,
+                                                        logging=self.logging)
         else:
           self.hidden_y_layer_x = MultiGraphAttention(input_dim=self.input_dim,
                                                 output_dim=FLAGS.hidden_y,
                                                 adj=self.adj,
                                                 act=tf.nn.elu,
                                                 features_nonzero=self.features_nonzero,
+                                                featureless=self.featureless,
+                                                sparse=self.sparse_inputs,
                                                 num_head = FLAGS.num_head,
                                                 dropout=self.dropout,
+                                                memoize=bool(FLAGS.share_input_branch),
                                                 logging=self.logging)
 
           self.hidden_y_layer_z1 = MultiGraphAttention(input_dim=FLAGS.dim_z1,
@@ -256,8 +357,9 @@ class GCNModelFeedback(Model):
         
         self.hidden_x_input_layer = GraphConvolutionDense(input_dim=self.input_dim,
                                       output_dim=FLAGS.hidden_x,
-                                      sparse_inputs = True,
+                                      sparse_inputs = self.sparse_inputs,
                                       features_nonzero=self.features_nonzero,
+                                      featureless=self.featureless,
                                       act=lambda x: x,
                                       dropout=0.,
                                       logging=self.logging)
@@ -276,49 +378,90 @@ class GCNModelFeedback(Model):
     
     def encoder_z1(self, inputs):
         hidden = self.hidden_z1q_layer(inputs)
+        if self.z1q_layer is not None:
+          return self.z1q_layer([hidden, hidden])
         return self.z1q_mean_layer(hidden), self.z1q_log_std_layer(hidden)
 
     def encoder_y(self, z1, inputs):
-        hidden = tf.concat((self.hidden_y_layer_x(inputs), self.hidden_y_layer_z1(z1)), 1)
+        if self.hidden_y_layer is not None:
+          hidden = self.hidden_y_layer([inputs, z1])
+        else:
+          hidden = tf.concat(broadcast_samples([self.hidden_y_layer_x(inputs), self.hidden_y_layer_z1(z1)]), -1)
         return self.y_layer(hidden)
 
     def encoder_z2(self, z1, y):
-        prior_full = tf.concat((z1, y), axis = 1)
-        hidden = self.hidden_z2_layer(prior_full)
-        return self.z2_mean_layer(hidden), self.z2_log_std_layer(hidden)
+        with self.dense_scope():
+          prior_full = tf.concat((z1, y), axis = -1)
+          hidden = self.hidden_z2_layer(prior_full)
+          return self.z2_mean_layer(hidden), self.z2_log_std_layer(hidden)
 
     def decoder_z1(self, z2, y):
-        prior_full = tf.concat((z2, y), axis = 1)
-        hidden = self.hidden_z1p_layer(prior_full)
-        return self.z1p_mean_layer(hidden), self.z1p_log_std_layer(hidden)
+        with self.dense_scope():
+          prior_full = tf.concat((z2, y), axis = -1)
+          hidden = self.hidden_z1p_layer(prior_full)
+          return self.z1p_mean_layer(hidden), self.z1p_log_std_layer(hidden)
 
     def decoder_x(self, z1):
-        # graph = self.reconstruct_graph(z1)
-        recon_1 = tf.nn.l2_normalize(z1, axis = 1)
-        recon_2 = tf.ones_like(recon_1)
-        recon_2 /= tf.sqrt(tf.reduce_sum(recon_2, axis = 1, keepdims = True))
+        # the input product may be sparse, so it is built outside the XLA cluster
+        x_input = self.hidden_x_input_layer._transform(self.inputs)
+
+        with self.dense_scope():
+          # graph = self.reconstruct_graph(z1)
+          # z1 may carry a leading sample axis, nodes are on axis -2
+          recon_1 = tf.nn.l2_normalize(z1, axis = -1)
+          recon_2 = tf.ones_like(recon_1)
+          recon_2 /= tf.sqrt(tf.reduce_sum(recon_2, axis = -1, keepdims = True))
 
-        d = tf.matmul(recon_1, tf.expand_dims(tf.reduce_sum(recon_1, axis = 0), 1)) + tf.matmul(recon_2, tf.expand_dims(tf.reduce_sum(recon_2, axis = 0), 1))
-        d = tf.pow(d, -0.5)
-        recon_1 *= d
-        recon_2 *= d
+          d = tf.matmul(recon_1, tf.reduce_sum(recon_1, axis = -2, keepdims = True), transpose_b = True) + tf.matmul(recon_2, tf.reduce_sum(recon_2, axis = -2, keepdims = True), transpose_b = True)
+          d = tf.pow(d, -0.5)
+          recon_1 *= d
+          recon_2 *= d
 
-        hidden = self.hidden_x_z1_layer((z1, recon_1, recon_2)) + self.hidden_x_input_layer((self.inputs, recon_1, recon_2))
-        hidden = tf.nn.relu(hidden)
-        emb = self.x_layer((hidden, recon_1, recon_2))
+          hidden = self.hidden_x_z1_layer((z1, recon_1, recon_2)) + self.hidden_x_input_layer._propagate(x_input, recon_1, recon_2)
+          hidden = tf.nn.relu(hidden)
+          emb = self.x_layer((hidden, recon_1, recon_2))
 
-        emb = (1 - FLAGS.autoregressive_scalar) * z1 + FLAGS.autoregressive_scalar * emb
+          emb = (1 - FLAGS.autoregressive_scalar) * z1 + FLAGS.autoregressive_scalar * emb
 
         #reconstructions = self.reconstruct_graph(emb, normalize = False)
         #return tf.reshape(reconstructions, [-1]), emb
 
         return emb, emb
 
+    def export_tensors(self):
+        tensors = super(GCNModelFeedback, self).export_tensors()
+        # decoder_x embeddings of the latent means, built only here to leave the training graph as it is
+        with tf.name_scope(self.name + '_export'):
+          tensors['decoded'] = self.decoder_x(self.z1q_mean)[1]
+        return tensors
+
+    def recompute_blocks(self):
+        """Recompute the activations of the blocks listed in --recompute on the backward pass.
+
+        encoder_y is not offered since it applies dropout; the sampling steps stay
+        outside the recomputed blocks for the same reason.
+        """
+        blocks = {'encoder_z1': ('encoder_z1', [self.hidden_z1q_layer, self.z1q_mean_layer, self.z1q_log_std_layer]),
+                  'decoder_x': ('decoder_x', [self.hidden_x_input_layer, self.hidden_x_z1_layer, self.x_layer]),
+                  'latent_z2': ('encoder_z2', [self.hidden_z2_layer, self.z2_mean_layer, self.z2_log_std_layer]),
+                  'latent_z1': ('decoder_z1', [self.hidden_z1p_layer, self.z1p_mean_layer, self.z1p_log_std_layer])}
+        names = []
+        for name in filter(None, FLAGS.recompute.split(',')):
+          names += ['latent_z2', 'latent_z1'] if name == 'latent' else [name]
+        for name in names:
+          if name not in blocks:
+            raise ValueError('Unknown block for --recompute: ' + name)
+          method, layers = blocks[name]
+          # the instance attribute shadows the method, also for the optimizer
+          setattr(self, method, recompute(getattr(self, method), layers))
+
     def _build(self):
         self.define_layers()
+        self.recompute_blocks()
   
         self.z1q_mean, self.z1q_log_std = self.encoder_z1(self.inputs)
-        self.z1q = self.sample(self.z1q_mean, self.z1q_log_std, FLAGS.dim_z1)
+        # with --num_samples > 1, z1q and everything computed from it gets a leading sample axis
+        self.z1q = self.sample(self.z1q_mean, self.z1q_log_std, FLAGS.dim_z1, FLAGS.num_samples)
 
         # self.reconstructions, self.zf = self.decoder_x(self.z1q)
         # _, self.zf_noiseless = self.decoder_x(self.z1q_mean)
@@ -330,5 +473,7 @@ class GCNModelFeedback(Model):
 
         self.y = self.encoder_y(self.z1q, self.inputs)
         self.outputs = self.encoder_y(self.z1q_mean, self.inputs)
+        self.embeddings = self.z1q_mean
+        self.embedding_hops = 2
 
 
@@ -1,6 +1,8 @@
 import tensorflow as tf
 import numpy as np
 
+from layers import xla_scope
+
 flags = tf.app.flags
 FLAGS = flags.FLAGS
 
@@ -38,7 +40,7 @@ def masked_accuracy(preds, labels, mask):
 
 def log_normal_pdf_tf(mean, log_std, obs, dim = 7):
     pdf = -0.5 * (tf.square(obs - mean) * tf.exp(-2.0 * log_std)) - 0.5 * (dim * tf.log(2 * np.pi) + 2 * log_std)
-    return tf.reduce_sum(pdf, 1)
+    return tf.reduce_sum(pdf, -1)
 
 # def kl_categorical(probs, prior):
 #     probs_dist = tf.contrib.distributions.Categorical(probs)
@@ -52,34 +54,93 @@ def kl_categorical(probs, dim, mask):
     dummy = tf.ones_like(probs) / (1.0 * dim)
     probs = dummy * full_mask + probs * (1 - full_mask)
 
-    kl = tf.reduce_sum(probs * tf.maximum(tf.log(probs * dim), -10000), 1)
+    kl = tf.reduce_sum(probs * tf.maximum(tf.log(probs * dim), -10000), -1)
     mask = 1 - mask
     mask /= tf.reduce_mean(mask)
     kl *= mask
     return kl
 
 def kl(mean, log_std):
-    return 0.5 * tf.reduce_sum(1 + 2 * log_std - tf.square(mean) - tf.square(tf.exp(log_std)), 1)
-
-class OptimizerSuper(object):
+    return 0.5 * tf.reduce_sum(1 + 2 * log_std - tf.square(mean) - tf.square(tf.exp(log_std)), -1)
+
+class Optimizer(object):
+    """Shared training ops of the optimizers below.
+
+    Gradients of self.cost are built once and exposed as self.grads_vars (and
+    their global norm as self.grad_norm) for monitoring. opt_op applies them with
+    Adam. With grad_accum > 1 the gradients can instead be accumulated over
+    several micro-batches: run zero_op, then accumulate_op once per micro-batch,
+    then apply_op, which applies their mean in a single Adam step.
+    """
+    def _minimize(self, learning_rate, grad_accum=1):
+        self.optimizer = tf.train.AdamOptimizer(learning_rate=learning_rate)  # Adam Optimizer
+        self.grads_vars = self.optimizer.compute_gradients(self.cost)
+        grads_vars = [(g, v) for g, v in self.grads_vars if g is not None]
+        self.grad_norm = tf.global_norm([g for g, v in grads_vars])
+        self.opt_op = self.optimizer.apply_gradients(grads_vars)
+        if grad_accum > 1:
+            self._accumulate(grads_vars)
+
+    def _accumulate(self, grads_vars):
+        with tf.variable_scope('accumulators'):
+            self.accumulators = [tf.Variable(tf.zeros_like(v.initialized_value()), trainable=False)
+                                 for g, v in grads_vars]
+            self.micro_batches = tf.Variable(0., trainable=False, name='micro_batches')
+
+        accumulate = [self.micro_batches.assign_add(1.)]
+        for (g, v), acc in zip(grads_vars, self.accumulators):
+            if isinstance(g, tf.IndexedSlices):
+                # row gradients of a lookup, avoid densifying them
+                accumulate.append(tf.scatter_add(acc, g.indices, g.values))
+            else:
+                accumulate.append(acc.assign_add(g))
+        self.accumulate_op = tf.group(*accumulate)
+
+        self.zero_op = tf.group(*[acc.assign(tf.zeros_like(acc)) for acc in self.accumulators + [self.micro_batches]])
+        scale = 1. / tf.maximum(self.micro_batches, 1.)
+        self.apply_op = self.optimizer.apply_gradients([(acc * scale, v) for acc, (g, v) in zip(self.accumulators, grads_vars)])
+
+class OptimizerSuper(Optimizer):
     def __init__(self, model):
 
         self.cost = model.weight_norm
 
-        self.cost += masked_softmax_cross_entropy(model.outputs, model.labels, model.labels_mask)
+        with xla_scope(FLAGS.xla):
+            self.cost += masked_softmax_cross_entropy(model.outputs, model.labels, model.labels_mask)
 
-        self.optimizer = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate)  # Adam Optimizer
-        self.opt_op = self.optimizer.minimize(self.cost)
-        self.grads_vars = self.optimizer.compute_gradients(self.cost)
+        self._minimize(FLAGS.learning_rate, FLAGS.grad_accum)
+
+        self.accuracy = masked_accuracy(model.outputs, model.labels, model.labels_mask)
+
+class OptimizerDistill(Optimizer):
+    """Trains a student on the soft targets of a teacher.
+
+    The cost is the cross-entropy between the teacher and student class
+    distributions at the given temperature over all nodes, scaled by
+    temperature**2 to keep its gradients comparable across temperatures, plus
+    hard_weight times the cross-entropy on the labeled nodes.
+    """
+    def __init__(self, model, teacher_logits, learning_rate, temperature=1., hard_weight=0., xla=False):
+
+        self.cost = model.weight_norm
+
+        with xla_scope(xla):
+            soft_targets = tf.nn.softmax(teacher_logits / temperature)
+            self.cost += temperature ** 2 * tf.reduce_mean(
+                tf.nn.softmax_cross_entropy_with_logits_v2(logits=model.outputs / temperature, labels=soft_targets))
+            if hard_weight > 0:
+                self.cost += hard_weight * masked_softmax_cross_entropy(model.outputs, model.labels, model.labels_mask)
+
+        self._minimize(learning_rate)
 
         self.accuracy = masked_accuracy(model.outputs, model.labels, model.labels_mask)
 
-class OptimizerSemiGen(object):
-    def __init__(self, preds, labels, model, num_nodes, pos_weight, norm):
+class OptimizerSemiGen(Optimizer):
+    def __init__(self, preds, labels, model, num_nodes, pos_weight, norm, subsample=0):
         preds_sub = preds
         labels_sub = labels
 
-        if FLAGS.subsample:
+        if subsample:
             indices = labels.indices
             no_edge_indices = tf.random_uniform(tf.shape(indices), maxval = num_nodes, dtype=tf.int64)
             no_edge_tensor = tf.SparseTensor(no_edge_indices, tf.zeros_like(labels.values), labels.dense_shape)
@@ -87,50 +148,56 @@ class OptimizerSemiGen(object):
             
             all_indices = all_tensor.indices
 
-            preds_vals = tf.reduce_sum(tf.gather(preds, all_indices[:,0]) * tf.gather(preds, all_indices[:,1]), axis = 1)
+            # preds may carry a leading sample axis, nodes are on the second to last one
+            node_axis = preds.shape.ndims - 2
+            preds_vals = tf.reduce_sum(tf.gather(preds, all_indices[:,0], axis = node_axis) * tf.gather(preds, all_indices[:,1], axis = node_axis), axis = -1)
             labels_vals = all_tensor.values
+            if node_axis > 0:
+                labels_vals += tf.zeros_like(preds_vals)
 
             self.cost = tf.reduce_mean(tf.nn.weighted_cross_entropy_with_logits(logits=preds_vals, targets=labels_vals, pos_weight=1))
         else:
-            preds_sub = tf.matmul(preds_sub, tf.transpose(preds_sub))
             labels_sub = tf.sparse_tensor_to_dense(labels_sub, validate_indices = False)
-            self.cost = norm * tf.reduce_mean(tf.nn.weighted_cross_entropy_with_logits(logits=preds_sub, targets=labels_sub, pos_weight=pos_weight))
+            with xla_scope(FLAGS.xla):
+                preds_sub = tf.matmul(preds_sub, preds_sub, transpose_b = True)
+                if preds.shape.ndims == 3:
+                    labels_sub += tf.zeros_like(preds_sub)
+                self.cost = norm * tf.reduce_mean(tf.nn.weighted_cross_entropy_with_logits(logits=preds_sub, targets=labels_sub, pos_weight=pos_weight))
 
-        y_semi = y_semi_supervised(tf.nn.softmax(model.y), model.labels, model.labels_mask)
-        y_prior = y_prior_distribution(model.labels, model.labels_mask, model.output_dim)
+        with xla_scope(FLAGS.xla):
+            y_semi = y_semi_supervised(tf.nn.softmax(model.y), model.labels, model.labels_mask)
+            y_prior = y_prior_distribution(model.labels, model.labels_mask, model.output_dim)
 
-        self.cost += (1.0 / num_nodes) * tf.reduce_mean(kl_categorical(y_semi, model.output_dim, model.labels_mask))
+            self.cost += (1.0 / num_nodes) * tf.reduce_mean(kl_categorical(y_semi, model.output_dim, model.labels_mask))
 
-        self.cost += (1.0 / num_nodes) * tf.reduce_mean(tf.maximum(log_normal_pdf_tf(model.z1q_mean, model.z1q_log_std, model.z1q, model.output_dim), -10000))
+            self.cost += (1.0 / num_nodes) * tf.reduce_mean(tf.maximum(log_normal_pdf_tf(model.z1q_mean, model.z1q_log_std, model.z1q, model.output_dim), -10000))
 
-        for label in range(model.output_dim):
-            y_pos = tf.one_hot(indices = label, depth = model.output_dim)
-            y_pos = tf.ones_like(model.y) * y_pos
+            for label in range(model.output_dim):
+                y_pos = tf.one_hot(indices = label, depth = model.output_dim)
+                y_pos = tf.ones_like(model.y) * y_pos
 
-            z2_mean, z2_log_std = model.encoder_z2(model.z1q, y_pos)
-            z2 = model.sample(z2_mean, z2_log_std, FLAGS.dim_z2)
-            z1p_mean, z1p_log_std = model.decoder_z1(z2, y_pos)
+                z2_mean, z2_log_std = model.encoder_z2(model.z1q, y_pos)
+                z2 = model.sample(z2_mean, z2_log_std, FLAGS.dim_z2)
+                z1p_mean, z1p_log_std = model.decoder_z1(z2, y_pos)
 
-            self.cost -= (1.0 / num_nodes) * tf.reduce_mean(y_semi[:,label] * kl(z2_mean, z2_log_std))
-            self.cost -= (1.0 / num_nodes) * tf.reduce_mean(y_semi[:,label] * tf.maximum(log_normal_pdf_tf(z1p_mean, z1p_log_std, model.z1q, model.output_dim), -10000))
-        
-        self.cost *= FLAGS.tau
+                self.cost -= (1.0 / num_nodes) * tf.reduce_mean(y_semi[...,label] * kl(z2_mean, z2_log_std))
+                self.cost -= (1.0 / num_nodes) * tf.reduce_mean(y_semi[...,label] * tf.maximum(log_normal_pdf_tf(z1p_mean, z1p_log_std, model.z1q, model.output_dim), -10000))
 
-        self.cost += FLAGS.alpha * masked_softmax_cross_entropy(model.outputs, model.labels, model.labels_mask)
-        self.cost += model.weight_norm
+            self.cost *= FLAGS.tau
 
-        self.optimizer = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate)  # Adam Optimizer
-        self.opt_op = self.optimizer.minimize(self.cost)
-        self.grads_vars = self.optimizer.compute_gradients(self.cost)
+            self.cost += FLAGS.alpha * masked_softmax_cross_entropy(model.outputs, model.labels, model.labels_mask)
+            self.cost += model.weight_norm
+
+        self._minimize(FLAGS.learning_rate, FLAGS.grad_accum)
 
         self.accuracy = masked_accuracy(model.outputs, model.labels, model.labels_mask)
 
-class OptimizerSemi(object):
-    def __init__(self, preds, labels, model, num_nodes, pos_weight, norm):
+class OptimizerSemi(Optimizer):
+    def __init__(self, preds, labels, model, num_nodes, pos_weight, norm, subsample=0):
         preds_sub = preds
         labels_sub = labels
 
-        if FLAGS.subsample:
+        if subsample:
             indices = labels.indices
             no_edge_indices = tf.random_uniform(tf.shape(indices), maxval = num_nodes, dtype=tf.int64)
             no_edge_tensor = tf.SparseTensor(no_edge_indices, tf.zeros_like(labels.values), labels.dense_shape)
@@ -138,25 +205,31 @@ class OptimizerSemi(object):
             
             all_indices = all_tensor.indices
 
-            preds_vals = tf.reduce_sum(tf.gather(preds, all_indices[:,0]) * tf.gather(preds, all_indices[:,1]), axis = 1)
+            # preds may carry a leading sample axis, nodes are on the second to last one
+            node_axis = preds.shape.ndims - 2
+            preds_vals = tf.reduce_sum(tf.gather(preds, all_indices[:,0], axis = node_axis) * tf.gather(preds, all_indices[:,1], axis = node_axis), axis = -1)
             labels_vals = all_tensor.values
+            if node_axis > 0:
+                labels_vals += tf.zeros_like(preds_vals)
 
             self.cost = tf.reduce_mean(tf.nn.weighted_cross_entropy_with_logits(logits=preds_vals, targets=labels_vals, pos_weight=1))
         else:
-            preds_sub = tf.matmul(preds_sub, tf.transpose(preds_sub))
             labels_sub = tf.sparse_tensor_to_dense(labels_sub, validate_indices = False)
-            self.cost = norm * tf.reduce_mean(tf.nn.weighted_cross_entropy_with_logits(logits=preds_sub, targets=labels_sub, pos_weight=pos_weight))
+            with xla_scope(FLAGS.xla):
+                preds_sub = tf.matmul(preds_sub, preds_sub, transpose_b = True)
+                if preds.shape.ndims == 3:
+                    labels_sub += tf.zeros_like(preds_sub)
+                self.cost = norm * tf.reduce_mean(tf.nn.weighted_cross_entropy_with_logits(logits=preds_sub, targets=labels_sub, pos_weight=pos_weight))
         
-        self.cost -= (1.0 / num_nodes) * tf.reduce_mean(kl(model.z1q_mean, model.z1q_log_std))
+        with xla_scope(FLAGS.xla):
+            self.cost -= (1.0 / num_nodes) * tf.reduce_mean(kl(model.z1q_mean, model.z1q_log_std))
 
-        self.cost *= FLAGS.tau
+            self.cost *= FLAGS.tau
 
-        self.cost += FLAGS.alpha * masked_softmax_cross_entropy(model.outputs, model.labels, model.labels_mask)
-        self.cost += model.weight_norm
+            self.cost += FLAGS.alpha * masked_softmax_cross_entropy(model.outputs, model.labels, model.labels_mask)
+            self.cost += model.weight_norm
 
-        self.optimizer = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate)  # Adam Optimizer
-        self.opt_op = self.optimizer.minimize(self.cost)
-        self.grads_vars = self.optimizer.compute_gradients(self.cost)
+        self._minimize(FLAGS.learning_rate, FLAGS.grad_accum)
 
         self.accuracy = masked_accuracy(model.outputs, model.labels, model.labels_mask)
 
@@ -0,0 +1,149 @@
+"""Memory and compute estimates of a train.py run, made before its graph is built.
+
+The estimates count the float32 tensors of one training step that grow with
+the graph: activations of the node-level layers (one row per node, kept for
+the backward pass), attention coefficients (one per edge and head), the
+reconstruction loss and the first-layer weights with their gradients and Adam
+slots, plus the fed inputs. The dense reconstruction loss of the graphite
+models (--subsample 0) materializes N x N labels and logits per sample, which
+is what runs out of memory first on large graphs; plan() can switch to the
+sampled loss (--subsample 1) when the dense one does not fit the budget, and
+raises MemoryError when the run does not fit.
+"""
+
+from __future__ import division
+
+import os
+
+GB = 2. ** 30
+FLOAT = 4
+# bytes per fed sparse entry: two int64 indices and a float32 value
+SPARSE_ENTRY = 20
+# float32 copies of an activation alive in a step: its value, its gradient and a temporary
+ACTIVATION_COPIES = 3
+# float32 values per attention coefficient: sparse sum, leaky relu, softmax, dropout and their gradients
+ATTENTION_COPIES = 8
+# float32 N x N tensors per sample of the dense loss: labels broadcast to the sample, logits, cross-entropy
+# terms and their gradients
+DENSE_LOSS_COPIES = 7
+
+def available_memory():
+    """Bytes of memory available to a new process, or None if unknown."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def layers(flags, num_classes):
+    """Node-level layers of one training step as (times run, input width, output width, kind).
+
+    The input width is None for layers taking the features; kind is 'graph' for a product with the sparse adjacency, 'attention' for
+    graph attention (per head), 'lowrank' for the propagation through the
+    graph reconstructed from z1 and 'dense' for none.
+    """
+    graph = 'attention' if flags.attention else 'graph'
+    heads = flags.num_head if flags.attention else 1
+    if flags.model not in ['graphite', 'graphite_kingma']:
+        return [(heads, None, flags.hidden_y, graph), (1, flags.hidden_y * heads, num_classes, graph)]
+
+    samples = max(flags.num_samples, 1)
+    result = [(1, None, flags.hidden_z1q, 'graph'), (2, flags.hidden_z1q, flags.dim_z1, 'graph'),
+              # decoder_x, once per sample
+              (samples, None, flags.hidden_x, 'lowrank'), (samples, flags.dim_z1, flags.hidden_x, 'lowrank'),
+              (samples, flags.hidden_x, flags.dim_z1, 'lowrank'),
+              # encoder_y on the samples and on the mean
+              ((samples + 1) * heads, None, flags.hidden_y, graph),
+              ((samples + 1) * heads, flags.dim_z1, flags.hidden_y, graph),
+              (samples + 1, 2 * flags.hidden_y * heads, num_classes, graph)]
+    if flags.model == 'graphite_kingma':
+        # encoder_z2 and decoder_z1 once per class and sample
+        times = samples * num_classes
+        result += [(times, flags.dim_z1 + num_classes, flags.hidden_z2, 'dense'),
+                   (2 * times, flags.hidden_z2, flags.dim_z2, 'dense'),
+                   (times, flags.dim_z2 + num_classes, flags.hidden_z1p, 'dense'),
+                   (2 * times, flags.hidden_z1p, flags.dim_z1, 'dense')]
+    return result
+
+def estimate(flags, num_nodes, num_edges, num_features, features_nonzero, num_classes, dense_features=False,
+             subsample=None):
+    """Peak bytes and floating point operations of one training step.
+
+    num_edges counts the nonzeros of the adjacency (both directions),
+    features_nonzero the fed feature entries (as model_inputs returns them).
+    Returns a dict with 'memory' and 'flops' and the part of the memory taken
+    by the reconstruction loss as 'loss_memory'.
+    """
+    subsample = flags.subsample if subsample is None else subsample
+    graphite = flags.model in ['graphite', 'graphite_kingma']
+    samples = max(flags.num_samples, 1) if graphite else 1
+    # both fed adjacencies have self-loops
+    nnz = num_edges + num_nodes
+
+    activations = flops = first_layer = attention = 0
+    for times, input_dim, output_dim, kind in layers(flags, num_classes):
+        if input_dim is None:
+            # feature products are sparse, or lookups of indexed features
+            flops += 2. * times * features_nonzero * output_dim
+            first_layer += output_dim
+        else:
+            flops += 2. * times * num_nodes * input_dim * output_dim
+        activations += times * output_dim * (1 if kind == 'dense' else 2)
+        if kind in ['graph', 'attention']:
+            flops += 2. * times * nnz * output_dim
+        if kind == 'attention':
+            attention += times
+            flops += 10. * times * nnz
+        if kind == 'lowrank':
+            flops += 4. * times * num_nodes * flags.dim_z1 * output_dim
+
+    memory = FLOAT * ACTIVATION_COPIES * num_nodes * float(activations)
+    memory += FLOAT * ATTENTION_COPIES * nnz * float(attention)
+    # first-layer weights with their gradients and Adam slots (and accumulators)
+    memory += FLOAT * (4 + (flags.grad_accum > 1)) * float(num_features) * first_layer
+    memory += 2 * SPARSE_ENTRY * float(nnz)
+    memory += FLOAT * float(features_nonzero) if dense_features else SPARSE_ENTRY * float(features_nonzero)
+
+    loss_memory = 0.
+    if graphite:
+        if subsample:
+            # gathered endpoints of the edges and as many sampled non-edges per sample, and their gradients
+            loss_memory = FLOAT * 2 * 4. * nnz * samples * flags.dim_z1
+            flops += 8. * nnz * samples * flags.dim_z1
+        else:
+            loss_memory = FLOAT * float(num_nodes) ** 2 * DENSE_LOSS_COPIES * samples
+            flops += (2. * flags.dim_z1 + 10.) * float(num_nodes) ** 2 * samples
+    memory += loss_memory
+    # the backward pass costs about twice the forward pass
+    return {'memory': memory, 'flops': 3 * flops, 'loss_memory': loss_memory}
+
+def plan(flags, num_nodes, num_edges, num_features, features_nonzero, num_classes, dense_features=False,
+         budget=None, switch=False):
+    """Chooses the reconstruction loss of a run for a memory budget in bytes.
+
+    Returns (subsample, estimate): the loss of flags.subsample is kept when it
+    fits or the budget is unknown; with switch, a dense loss that does not fit
+    is replaced by the sampled one. Raises MemoryError when the estimate of the
+    chosen variant exceeds the budget.
+    """
+    args = (flags, num_nodes, num_edges, num_features, features_nonzero, num_classes, dense_features)
+    subsample = flags.subsample
+    result = estimate(*args, subsample=subsample)
+    if switch and budget and result['memory'] > budget and not subsample and \
+            flags.model in ['graphite', 'graphite_kingma']:
+        subsample = 1
+        result = estimate(*args, subsample=subsample)
+    if budget and result['memory'] > budget:
+        raise MemoryError(
+            'estimated peak memory {:.3g} GB of {} with {} nodes, {} edges and {} feature entries exceeds the '
+            'budget of {:.3g} GB ({:.3g} GB in the {} reconstruction loss); lower the hidden sizes, --num_samples '
+            'or --num_head, use --subsample 1, or raise --memory_budget_gb'.format(
+                result['memory'] / GB, flags.model, num_nodes, num_edges, features_nonzero, budget / GB,
+                result['loss_memory'] / GB, 'sampled' if subsample else 'dense'))
+    return subsample, result
@@ -0,0 +1,70 @@
+import threading
+import sys
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+class Prefetcher(object):
+    """Runs producer(t, rng) for t = 0..num_items-1 in background threads.
+
+    Items are yielded in order while later ones are being computed, so host-side
+    work for epoch t+1 (edge dropout, normalization, feed dicts) overlaps with the
+    session run of epoch t. Worker k produces items t with t % num_workers == k and
+    keeps at most `capacity` finished items queued.
+
+    Every item gets its own RandomState seeded from np.random when the prefetcher
+    is created, so results are reproducible under a fixed numpy seed whatever the
+    number of workers or thread scheduling.
+    """
+    def __init__(self, producer, num_items, num_workers=1, capacity=2):
+        assert num_workers > 0, 'Prefetcher needs at least one worker'
+        self.producer = producer
+        self.num_items = num_items
+        self.num_workers = num_workers
+        self.seeds = np.random.randint(np.iinfo(np.int32).max, size=num_items)
+        self.stopped = threading.Event()
+        maxsize = max(1, int(np.ceil(capacity * 1.0 / num_workers)))
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in range(num_workers)]
+        self.threads = []
+        for k in range(num_workers):
+            thread = threading.Thread(target=self._work, args=(k,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _put(self, q, item):
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _work(self, k):
+        for t in range(k, self.num_items, self.num_workers):
+            if self.stopped.is_set():
+                return
+            try:
+                item = (True, self.producer(t, np.random.RandomState(self.seeds[t])))
+            except Exception:
+                item = (False, sys.exc_info()[1])
+            if not self._put(self.queues[k], item) or not item[0]:
+                return
+
+    def __iter__(self):
+        try:
+            for t in range(self.num_items):
+                ok, item = self.queues[t % self.num_workers].get()
+                if not ok:
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
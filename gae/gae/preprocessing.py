@@ -1,15 +1,111 @@
+import os
+import time
 import numpy as np
 import scipy.sparse as sp
-import networkx as nx
+from scipy.sparse.csgraph import minimum_spanning_tree, reverse_cuthill_mckee, breadth_first_order, connected_components
+from multiprocessing.pool import ThreadPool
 
-def preprocess_features(features):
-    """Row-normalize feature matrix and convert to tuple representation"""
+def normalize_features(features):
+    """Row-normalize feature matrix"""
     rowsum = np.array(features.sum(1))
     r_inv = np.power(rowsum, -1).flatten()
     r_inv[np.isinf(r_inv)] = 0.
     r_mat_inv = sp.diags(r_inv)
-    features = r_mat_inv.dot(features)
-    return sparse_to_tuple(features)
+    return r_mat_inv.dot(features)
+
+def preprocess_features(features):
+    """Row-normalize feature matrix and convert to tuple representation"""
+    return sparse_to_tuple(normalize_features(features))
+
+def reduce_features(features, dim, method='projection', seed=0):
+    """Row-normalize features and reduce them to dim dense columns.
+
+    method is 'projection' (very sparse random projection) or 'svd'
+    (randomized truncated SVD).
+    """
+    from sklearn.random_projection import SparseRandomProjection
+    from sklearn.decomposition import TruncatedSVD
+
+    features = sp.csr_matrix(normalize_features(features))
+    if method == 'projection':
+        reducer = SparseRandomProjection(n_components=dim, dense_output=True, random_state=seed)
+    elif method == 'svd':
+        reducer = TruncatedSVD(n_components=dim, algorithm='randomized', random_state=seed)
+    else:
+        raise ValueError('Unknown feature reduction: ' + method)
+    return np.asarray(reducer.fit_transform(features), dtype=np.float32)
+
+def positional_features(adj, dim, hops=3, seed=0):
+    """Node positions from random projections propagated over the graph.
+
+    Every node starts from a random Gaussian vector of size dim; the positions are
+    the sum of its 1..hops step propagations with the normalized adjacency, so
+    that nearby nodes get similar positions. Columns are scaled to a variance of
+    1 / dim, which gives rows of unit norm on average, on the scale of row
+    normalized features.
+    """
+    adj_norm = normalize_adjacency(adj)
+    x = np.random.RandomState(seed).standard_normal((adj.shape[0], dim)).astype(np.float32)
+    positions = np.zeros_like(x)
+    for _ in range(hops):
+        x = adj_norm.dot(x)
+        positions += x
+    std = positions.std(axis=0) * np.sqrt(dim)
+    std[std == 0] = 1.
+    return positions / std
+
+def cached_reduce_features(features, dim, method, cache_prefix, version, seed=0):
+    """reduce_features, computed once and stored in a .npy file starting with cache_prefix.
+
+    The file name holds the method, dim, seed and the version of the features
+    (e.g. input_data.dataset_version), so features of a dataset saved again
+    are reduced again instead of being read from the previous cache.
+    """
+    cache_file = '{}.{}{}.seed{}.{}.npy'.format(cache_prefix, method, dim, seed, version[:16])
+    if os.path.isfile(cache_file):
+        reduced = np.load(cache_file)
+        if reduced.shape == (features.shape[0], dim):
+            return reduced
+    reduced = reduce_features(features, dim, method, seed)
+    np.save(cache_file, reduced)
+    return reduced
+
+def model_inputs(features, featureless=False, num_nodes=None, indexed=None):
+    """Features in the form the models take them.
+
+    Identity (featureless) and one-hot features become one column index per
+    node, dense features are cast to float32 and other sparse features are row
+    normalized. Returns features (None when indexed), feature_index (None when
+    not), num_features and features_nonzero.
+
+    indexed fixes the format for rows of features a model was built for (None
+    detects it): a subset of the rows of sparse features can be one-hot
+    without the full matrix being so.
+    """
+    feature_index = None
+    if featureless:
+        feature_index = np.arange(num_nodes)
+        num_features = num_nodes
+    elif sp.issparse(features) and indexed is not False:
+        feature_index = one_hot_index(features)
+        num_features = features.shape[1]
+        if feature_index is None and indexed:
+            raise ValueError('The model takes one-hot features, these rows are not')
+
+    if feature_index is not None:
+        return None, feature_index, num_features, feature_index.shape[0]
+    if not sp.issparse(features):
+        features = np.asarray(features, dtype=np.float32)
+        return features, None, features.shape[1], features.size
+    features = preprocess_features(features)
+    return features, None, features[2][1], features[1].shape[0]
+
+def one_hot_index(features):
+    """Column of the single nonzero of every row, or None if features are not one-hot."""
+    features = sp.csr_matrix(features)
+    if features.nnz != features.shape[0] or np.any(np.diff(features.indptr) != 1) or np.any(features.data == 0):
+        return None
+    return features.indices.astype(np.int64)
 
 def sparse_to_tuple(sparse_mx):
     if not sp.isspmatrix_coo(sparse_mx):
@@ -19,13 +115,102 @@ def sparse_to_tuple(sparse_mx):
     shape = sparse_mx.shape
     return coords, values, shape
 
+def _row_blocks(indptr, block_size):
+    """Split rows into consecutive ranges holding about block_size entries each."""
+    num_rows = len(indptr) - 1
+    blocks = []
+    start = 0
+    while start < num_rows:
+        stop = np.searchsorted(indptr, indptr[start] + block_size, side='right') - 1
+        stop = min(max(stop, start + 1), num_rows)
+        blocks.append((start, stop))
+        start = stop
+    return blocks
+
+def _map_blocks(fn, blocks, num_threads):
+    if num_threads == 1 or len(blocks) == 1:
+        return [fn(block) for block in blocks]
+    pool = ThreadPool(num_threads)
+    try:
+        return pool.map(fn, blocks)
+    finally:
+        pool.close()
+
+def add_self_loops(adj, dtype=None, copy=True, num_threads=None, block_size=1 << 22):
+    """A + I on the CSR arrays, inserting missing diagonal entries in a single pass."""
+    adj = sp.csr_matrix(adj)
+    if not adj.has_sorted_indices:
+        adj = adj.sorted_indices()
+    dtype = np.dtype(dtype or np.promote_types(adj.dtype, np.float32))
+    indptr, indices = adj.indptr, adj.indices
+
+    def diagonal(block):
+        # entries left of the diagonal and whether the diagonal is stored
+        start, stop = block
+        lo, hi = indptr[start], indptr[stop]
+        rows = np.repeat(np.arange(start, stop), np.diff(indptr[start:stop + 1]))
+        cols = indices[lo:hi]
+        below = np.bincount(rows[cols < rows] - start, minlength=stop - start)
+        has_diag = np.bincount(rows[cols == rows] - start, minlength=stop - start) > 0
+        return below, has_diag
+
+    below, has_diag = zip(*_map_blocks(diagonal, _row_blocks(indptr, block_size), num_threads))
+    pos = indptr[:-1] + np.concatenate(below)
+    has_diag = np.concatenate(has_diag)
+
+    missing = np.where(~has_diag)[0]
+    if len(missing) == 0:
+        data = adj.data.astype(dtype, copy=copy)
+        if copy:
+            indices, indptr = indices.copy(), indptr.copy()
+    else:
+        data = np.insert(adj.data, pos[missing], 0).astype(dtype, copy=False)
+        indices = np.insert(indices, pos[missing], missing)
+        shift = np.concatenate(([0], np.cumsum(~has_diag)))
+        pos = pos + shift[:-1]
+        indptr = indptr + shift
+    data[pos] += 1
+    return sp.csr_matrix((data, indices, indptr), shape=adj.shape, copy=False)
+
+def normalize_adjacency(adj, self_loops=True, dtype=None, copy=True, num_threads=None, block_size=1 << 22):
+    """D^-1/2 (A+I) D^-1/2 computed directly on the CSR arrays.
+
+    Self-loops are inserted in one pass, the degrees are accumulated and the
+    values are scaled in place, block by block over rows of about block_size
+    entries in a thread pool. Rows of zero degree are left at zero.
+    """
+    if self_loops:
+        adj = add_self_loops(adj, dtype=dtype, copy=copy, num_threads=num_threads, block_size=block_size)
+    else:
+        adj = sp.csr_matrix(adj)
+        adj = sp.csr_matrix(adj, dtype=dtype or np.promote_types(adj.dtype, np.float32), copy=copy)
+    indptr, indices, data = adj.indptr, adj.indices, adj.data
+    blocks = _row_blocks(indptr, block_size)
+
+    def block_rows(block):
+        start, stop = block
+        return np.repeat(np.arange(start, stop), np.diff(indptr[start:stop + 1]))
+
+    def degrees(block):
+        start, stop = block
+        lo, hi = indptr[start], indptr[stop]
+        return np.bincount(block_rows(block) - start, weights=data[lo:hi], minlength=stop - start)
+
+    rowsum = np.concatenate(_map_blocks(degrees, blocks, num_threads))
+    degree_inv_sqrt = np.zeros(len(rowsum), dtype=data.dtype)
+    nonzero = rowsum > 0
+    degree_inv_sqrt[nonzero] = np.power(rowsum[nonzero], -0.5)
+
+    def scale(block):
+        start, stop = block
+        lo, hi = indptr[start], indptr[stop]
+        data[lo:hi] *= degree_inv_sqrt[block_rows(block)] * degree_inv_sqrt[indices[lo:hi]]
+
+    _map_blocks(scale, blocks, num_threads)
+    return adj
+
 def preprocess_graph_coo(adj):
-    adj = sp.coo_matrix(adj)
-    adj_ = adj + sp.eye(adj.shape[0])
-    rowsum = np.array(adj_.sum(1))
-    degree_mat_inv_sqrt = sp.diags(np.power(rowsum, -0.5).flatten())
-    adj_normalized = adj_.dot(degree_mat_inv_sqrt).transpose().dot(degree_mat_inv_sqrt).tocoo()
-    return adj_normalized
+    return normalize_adjacency(adj).tocoo()
 
 def preprocess_partials(adj):
     adj = sp.lil_matrix(adj)
@@ -40,12 +225,227 @@ def preprocess_partials(adj):
     return partials
 
 def preprocess_graph(adj):
+    return sparse_to_tuple(normalize_adjacency(adj))
+
+def _row_entries(adj, rows):
+    """Positions in rows, column indices and values of the entries of the given CSR rows."""
+    indptr = adj.indptr
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    ends = np.cumsum(counts)
+    offsets = np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+    return np.repeat(np.arange(len(rows)), counts), adj.indices[offsets], adj.data[offsets]
+
+def khop_nodes(adj, nodes, hops):
+    """Sorted ids of the given nodes and of all nodes within `hops` hops of them.
+
+    Only the CSR rows of the nodes reached are read, so the cost grows with the
+    size of the neighborhood, not with the graph.
+    """
+    adj = sp.csr_matrix(adj, copy=False)
+    reached = frontier = np.unique(np.asarray(nodes, dtype=np.int64))
+    for _ in range(hops):
+        if len(frontier) == 0:
+            break
+        neighbors = np.unique(_row_entries(adj, frontier)[1])
+        frontier = np.setdiff1d(neighbors, reached, assume_unique=True)
+        reached = np.union1d(reached, frontier)
+    return reached
+
+def induced_subgraph(adj, nodes):
+    """Rows and columns `nodes` of adj as a CSR matrix, read from the rows of the nodes only.
+
+    Taken from the globally normalized adjacency the entries keep the degrees of
+    the full graph. With sorted nodes each row keeps the column order of adj.
+    Columns are looked up by binary search, or in a table over all nodes once
+    the rows read hold more entries than the graph has nodes.
+    """
+    adj = sp.csr_matrix(adj, copy=False)
+    nodes = np.asarray(nodes, dtype=np.int64)
+    rows, cols, values = _row_entries(adj, nodes)
+    if len(cols) > adj.shape[1]:
+        position = np.full(adj.shape[1], -1, dtype=np.int64)
+        position[nodes] = np.arange(len(nodes))
+        cols = position[cols]
+        keep = cols >= 0
+        return sp.csr_matrix((values[keep], (rows[keep], cols[keep])), shape=(len(nodes), len(nodes)))
+    order = np.argsort(nodes, kind='mergesort')
+    sorted_nodes = nodes[order]
+    pos = np.minimum(np.searchsorted(sorted_nodes, cols), len(nodes) - 1)
+    keep = sorted_nodes[pos] == cols
+    return sp.csr_matrix((values[keep], (rows[keep], order[pos[keep]])), shape=(len(nodes), len(nodes)))
+
+def node_ordering(adj, method):
+    """Node permutation improving the memory locality of adjacency products.
+
+    method is 'rcm' (reverse Cuthill-McKee), 'degree' (decreasing degree) or
+    'bfs' (breadth-first from the highest degree node of every component).
+    Node i of the reordered graph is node perm[i] of the original one.
+    """
+    adj = sp.csr_matrix(adj)
+    if method == 'rcm':
+        return reverse_cuthill_mckee(adj, symmetric_mode=True).astype(np.int64)
+    degrees = np.diff(adj.indptr)
+    if method == 'degree':
+        return np.argsort(-degrees, kind='mergesort')
+    if method == 'bfs':
+        num_components, component = connected_components(adj, directed=False)
+        by_degree = np.argsort(-degrees, kind='mergesort')
+        _, roots = np.unique(component[by_degree], return_index=True)
+        roots = by_degree[np.sort(roots)]
+        return np.concatenate([breadth_first_order(adj, root, directed=False, return_predecessors=False)
+                               for root in roots]).astype(np.int64)
+    raise ValueError('Unknown node ordering: ' + method)
+
+def permute_nodes(perm, adj, features, *node_arrays):
+    """Apply a node permutation to the adjacency, the features and per-node arrays."""
+    adj = sp.csr_matrix(adj)[perm][:, perm]
+    features = sp.csr_matrix(features)[perm] if sp.issparse(features) else features[perm]
+    return (adj, features) + tuple(array[perm] for array in node_arrays)
+
+def restore_order(outputs, perm):
+    """Map per-node outputs of a permuted graph back to the original node order."""
+    restored = np.empty_like(outputs)
+    restored[perm] = outputs
+    return restored
+
+def edge_span(adj):
+    """Mean |i - j| over the adjacency entries, a proxy for SpMM locality."""
     adj = sp.coo_matrix(adj)
-    adj_ = adj + sp.eye(adj.shape[0])
-    rowsum = np.array(adj_.sum(1))
-    degree_mat_inv_sqrt = sp.diags(np.power(rowsum, -0.5).flatten())
-    adj_normalized = adj_.dot(degree_mat_inv_sqrt).transpose().dot(degree_mat_inv_sqrt).tocoo()
-    return sparse_to_tuple(adj_normalized)
+    return np.abs(adj.row.astype(np.int64) - adj.col).mean() if adj.nnz else 0.
+
+def spmm_seconds(adj, width=16, repeats=10):
+    """Median seconds of the product of the normalized adjacency with a dense width column matrix."""
+    adj_norm = normalize_adjacency(adj)
+    dense = np.random.RandomState(0).rand(adj.shape[0], width).astype(np.float32)
+    times = []
+    for _ in range(repeats + 1):
+        t = time.time()
+        adj_norm.dot(dense)
+        times.append(time.time() - t)
+    # the first product warms the caches
+    return np.median(times[1:])
+
+class NormalizedAdjacency(object):
+    """D^-1/2 (A+I) D^-1/2 kept up to date under edge insertions and deletions.
+
+    update() changes the degrees of the touched nodes only and re-scales the
+    entries in their rows and columns; everything else keeps its value. After
+    every effective update, `delta` holds the sparse difference to the previous
+    normalized matrix (to patch copies kept elsewhere, e.g. in-graph tensors) and
+    `version` is incremented so that caches built on top can be invalidated.
+    """
+    def __init__(self, adj):
+        self.adj = add_self_loops(adj, dtype=np.float64)
+        self.degrees = np.asarray(self.adj.sum(1)).flatten()
+        self.degree_inv_sqrt = np.power(self.degrees, -0.5)
+        self.normalized = normalize_adjacency(self.adj, self_loops=False)
+        self.delta = sp.csr_matrix(self.adj.shape)
+        self.version = 0
+
+    @property
+    def num_nodes(self):
+        return self.adj.shape[0]
+
+    def to_tuple(self):
+        """Same representation as preprocess_graph."""
+        return sparse_to_tuple(self.normalized)
+
+    def delta_tuple(self):
+        return sparse_to_tuple(self.delta)
+
+    def _edge_values(self, edges):
+        if edges.shape[0] == 0:
+            return np.zeros(0)
+        return np.asarray(self.adj[edges[:, 0], edges[:, 1]]).flatten()
+
+    def _canonical(self, edges):
+        edges = np.asarray(edges if edges is not None else [], dtype=np.int64).reshape(-1, 2)
+        edges = np.vstack((np.minimum(edges[:, 0], edges[:, 1]), np.maximum(edges[:, 0], edges[:, 1]))).transpose()
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        _, first = np.unique(edge_keys(edges, self.num_nodes), return_index=True)
+        return edges[np.sort(first)]
+
+    @staticmethod
+    def _append_self_loops(mat, count):
+        """CSR mat grown by count rows and columns holding only their diagonal entry 1."""
+        num_nodes = mat.shape[0]
+        nnz = mat.indptr[-1]
+        indptr = np.concatenate((mat.indptr, nnz + np.arange(1, count + 1, dtype=mat.indptr.dtype)))
+        indices = np.concatenate((mat.indices, np.arange(num_nodes, num_nodes + count, dtype=mat.indices.dtype)))
+        data = np.concatenate((mat.data, np.ones(count, dtype=mat.data.dtype)))
+        return sp.csr_matrix((data, indices, indptr), shape=(num_nodes + count, num_nodes + count), copy=False)
+
+    def add_nodes(self, count):
+        """Append count isolated nodes, numbered from num_nodes on; returns delta.
+
+        A new node only has its self-loop, so its degree and normalized entry
+        are 1 and no existing entry changes. Connect it with update().
+        """
+        if count <= 0:
+            self.delta = sp.csr_matrix(self.adj.shape)
+            return self.delta
+        start = self.num_nodes
+        self.adj = self._append_self_loops(self.adj, count)
+        self.normalized = self._append_self_loops(self.normalized, count)
+        self.degrees = np.concatenate((self.degrees, np.ones(count)))
+        self.degree_inv_sqrt = np.concatenate((self.degree_inv_sqrt, np.ones(count)))
+        new = np.arange(start, start + count)
+        self.delta = sp.csr_matrix((np.ones(count), (new, new)), shape=self.adj.shape)
+        self.version += 1
+        return self.delta
+
+    def _region(self, mat, nodes, in_nodes):
+        """Entries of symmetric mat lying in the rows or columns of nodes."""
+        rows = mat[nodes].tocoo()
+        row = nodes[rows.row]
+        outside = ~in_nodes[rows.col]
+        coo = sp.coo_matrix((np.concatenate((rows.data, rows.data[outside])),
+                             (np.concatenate((row, rows.col[outside])), np.concatenate((rows.col, row[outside])))),
+                            shape=mat.shape)
+        return coo
+
+    def update(self, insertions=None, deletions=None):
+        """Insert and delete undirected edges given as (u, v) rows; returns delta."""
+        insertions = self._canonical(insertions)
+        deletions = self._canonical(deletions)
+        insertions = insertions[self._edge_values(insertions) == 0]
+        deletion_values = self._edge_values(deletions)
+        deletions = deletions[deletion_values != 0]
+        deletion_values = deletion_values[deletion_values != 0]
+
+        edges = np.vstack((insertions, deletions))
+        if edges.shape[0] == 0:
+            self.delta = sp.csr_matrix(self.adj.shape)
+            return self.delta
+        values = np.concatenate((np.ones(insertions.shape[0]), -deletion_values))
+
+        nodes = np.unique(edges)
+        in_nodes = np.zeros(self.num_nodes, dtype=bool)
+        in_nodes[nodes] = True
+        old_region = self._region(self.normalized, nodes, in_nodes)
+
+        change = sp.csr_matrix((np.concatenate((values, values)),
+                                (np.concatenate((edges[:, 0], edges[:, 1])), np.concatenate((edges[:, 1], edges[:, 0])))),
+                               shape=self.adj.shape)
+        self.adj = self.adj + change
+        self.adj.eliminate_zeros()
+        np.add.at(self.degrees, edges[:, 0], values)
+        np.add.at(self.degrees, edges[:, 1], values)
+        with np.errstate(divide='ignore'):
+            self.degree_inv_sqrt[nodes] = np.power(self.degrees[nodes], -0.5)
+        self.degree_inv_sqrt[nodes[np.isinf(self.degree_inv_sqrt[nodes])]] = 0.
+
+        new_region = self._region(self.adj, nodes, in_nodes)
+        new_region.data *= self.degree_inv_sqrt[new_region.row] * self.degree_inv_sqrt[new_region.col]
+
+        self.delta = sp.csr_matrix(new_region) - sp.csr_matrix(old_region)
+        self.delta.eliminate_zeros()
+        self.normalized = self.normalized + self.delta
+        # deleted entries cancel exactly
+        self.normalized.eliminate_zeros()
+        self.version += 1
+        return self.delta
 
 def construct_feed_dict(adj_normalized, adj, features, labels, labels_mask, placeholders):
     # construct feed dictionary
@@ -54,94 +454,109 @@ def construct_feed_dict(adj_normalized, adj, features, labels, labels_mask, plac
     feed_dict.update({placeholders['labels_mask']: labels_mask})
     feed_dict.update({placeholders['adj']: adj_normalized})
     feed_dict.update({placeholders['adj_orig']: adj})
-    feed_dict.update({placeholders['features']: features})
+    if 'features' in placeholders:
+        feed_dict.update({placeholders['features']: features})
     return feed_dict
 
-def edge_dropout(adj, dropout):
-
+def remove_self_loops(adj):
     adj = adj - sp.dia_matrix((adj.diagonal()[np.newaxis, :], [0]), shape=adj.shape)
     adj.eliminate_zeros()
-    assert np.diag(adj.todense()).sum() == 0
+    return adj
+
+def edge_keys(edges, num_nodes):
+    """Encode (u, v) rows as scalar keys for vectorized set operations."""
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    return edges[:, 0] * num_nodes + edges[:, 1]
+
+def remove_edges(adj, edges):
+    """Remove undirected edges (both directions) from a symmetric adjacency."""
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    removed = sp.csr_matrix((np.ones(edges.shape[0]), (edges[:, 0], edges[:, 1])), shape=adj.shape)
+    removed = removed + removed.T
+    adj = sp.csr_matrix(adj) - sp.csr_matrix(adj).multiply(removed > 0)
+    adj.eliminate_zeros()
+    return sp.csr_matrix(adj)
 
-    adj_triu = sp.triu(adj)
-    adj_tuple = sparse_to_tuple(adj_triu)
-    edges = adj_tuple[0]
-    num_val = int(np.floor(edges.shape[0] * 1.0 * dropout))
+def edge_dropout(adj, dropout, rng=np.random):
 
-    all_edge_idx = range(edges.shape[0])
-    np.random.shuffle(all_edge_idx)
-    val_edge_idx = all_edge_idx[:num_val]
-    train_edges = np.delete(edges, val_edge_idx, axis=0)
+    adj = remove_self_loops(adj)
+    assert adj.diagonal().sum() == 0
 
-    data = np.ones(train_edges.shape[0])
+    adj_triu = sp.triu(adj).tocoo()
+    num_val = int(np.floor(adj_triu.nnz * 1.0 * dropout))
+    train_edge_idx = rng.permutation(adj_triu.nnz)[num_val:]
+
+    data = np.ones(train_edge_idx.shape[0])
 
     # Re-build adj matrix
-    adj_train = sp.csr_matrix((data, (train_edges[:, 0], train_edges[:, 1])), shape=adj.shape)
+    adj_train = sp.csr_matrix((data, (adj_triu.row[train_edge_idx], adj_triu.col[train_edge_idx])), shape=adj.shape)
     adj_train = adj_train + adj_train.T
 
     return adj_train
 
-def pick_edges(graph, count):
-    G = nx.Graph(graph)
-    edges = []
-    while len(edges) < count:
-        G_edges = G.edges()
-        i = np.random.randint(len(G_edges))
-        u, v = G_edges[i]
-        G.remove_edge(u, v)
-
-        if nx.has_path(G, u, v):
-            edges.append([min(u,v), max(u,v)])
-        else:
-            G.add_edge(u, v)
-    return edges
-
-def pick_false_edges(graph, count):
-    G = nx.Graph(graph)
-    edges = []
-    while len(edges) < count:
-        G_nodes = G.nodes()
-        i = np.random.randint(len(G_nodes))
-        j = np.random.randint(len(G_nodes))
-        u = G_nodes[i]
-        v = G_nodes[j]
-
-        if v not in G.neighbors(u) + [u]:
-            edges.append([min(u,v), max(u,v)])
-            G.add_edge(u, v)
-    return edges
+def pick_edges(adj, count):
+    """Pick count edges whose joint removal keeps every connected component connected.
+
+    Edges outside a random spanning forest can all be removed together without
+    disconnecting the graph, so they are sampled from those.
+    """
+    adj_triu = sp.triu(adj, 1).tocoo()
+    weights = np.random.uniform(1., 2., adj_triu.nnz)
+    forest = minimum_spanning_tree(sp.csr_matrix((weights, (adj_triu.row, adj_triu.col)), shape=adj.shape)).tocoo()
+
+    num_nodes = adj.shape[0]
+    forest_edges = np.vstack((np.minimum(forest.row, forest.col), np.maximum(forest.row, forest.col))).transpose()
+    edges = np.vstack((adj_triu.row, adj_triu.col)).transpose()
+    candidates = edges[~np.isin(edge_keys(edges, num_nodes), edge_keys(forest_edges, num_nodes))]
+    if candidates.shape[0] < count:
+        raise ValueError('Only {} edges can be removed without disconnecting the graph, {} requested'.format(
+            candidates.shape[0], count))
+    return candidates[np.random.choice(candidates.shape[0], count, replace=False)]
+
+def pick_false_edges(adj, count):
+    """Pick count distinct node pairs (u < v) that are not edges of adj."""
+    num_nodes = adj.shape[0]
+    adj_triu = sp.triu(adj, 1).tocoo()
+    existing = edge_keys(np.vstack((adj_triu.row, adj_triu.col)).transpose(), num_nodes)
+    keys = np.zeros(0, dtype=np.int64)
+    while keys.shape[0] < count:
+        size = 2 * (count - keys.shape[0]) + 16
+        i = np.random.randint(num_nodes, size=size)
+        j = np.random.randint(num_nodes, size=size)
+        u, v = np.minimum(i, j), np.maximum(i, j)
+        new_keys = (u * num_nodes + v)[u != v]
+        new_keys = new_keys[~np.isin(new_keys, existing) & ~np.isin(new_keys, keys)]
+        _, first = np.unique(new_keys, return_index=True)
+        keys = np.concatenate((keys, new_keys[np.sort(first)]))[:count]
+    return np.vstack((keys // num_nodes, keys % num_nodes)).transpose()
 
 def get_test_edges(adj):
-    adj = adj - sp.dia_matrix((adj.diagonal()[np.newaxis, :], [0]), shape=adj.shape)
-    adj.eliminate_zeros()
-    edges_all = sparse_to_tuple(adj)[0].tolist()
+    adj = remove_self_loops(sp.csr_matrix(adj))
+    edges_all = sparse_to_tuple(adj)[0]
+    num_nodes = adj.shape[0]
 
-    edge_count = len(edges_all) / 2.0
+    edge_count = edges_all.shape[0] / 2.0
     num_test = int(np.floor(edge_count / 10.))
     num_val = int(np.floor(edge_count / 20.))
 
-    G = nx.to_networkx_graph(adj)
-    test_edges = pick_edges(G, num_test)
-    test_edges_false = pick_false_edges(G, num_test)
+    test_edges = pick_edges(adj, num_test)
+    test_edges_false = pick_false_edges(adj, num_test)
 
-    G.remove_edges_from(test_edges)
-    val_edges = pick_edges(G, num_val)
-    val_edges_false = pick_false_edges(G, num_val)
+    adj = remove_edges(adj, test_edges)
+    val_edges = pick_edges(adj, num_val)
+    val_edges_false = pick_false_edges(adj, num_val)
 
-    G.remove_edges_from(val_edges)
-    adj_train = nx.to_scipy_sparse_matrix(G)
-    train_edges = sparse_to_tuple(adj_train)[0].tolist()
+    adj_train = remove_edges(adj, val_edges)
+    train_edges = sparse_to_tuple(adj_train)[0]
 
     def ismember(a, b):
-        seta = set([tuple(x) for x in a])
-        setb = set([tuple(x) for x in b])
-        return len(seta & setb) > 0
+        return np.isin(edge_keys(a, num_nodes), edge_keys(b, num_nodes)).any()
 
     assert not ismember(test_edges_false, edges_all)
-    assert not ismember(val_edges_false, val_edges + train_edges)
+    assert not ismember(val_edges_false, np.vstack((val_edges, train_edges)))
     assert not ismember(val_edges, train_edges)
     assert not ismember(test_edges, train_edges)
     assert not ismember(val_edges, test_edges)
     assert ismember(val_edges, val_edges)
 
-    return adj_train, train_edges, val_edges, val_edges_false, test_edges, test_edges_false
\ No newline at end of file
+    return adj_train, train_edges, val_edges, val_edges_false, test_edges, test_edges_false
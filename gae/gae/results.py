@@ -0,0 +1,115 @@
+"""Persistent store of training results (SQLite), used by sweep.py to skip runs that are already done.
+
+    python results.py --db sweep.db
+
+Every run is stored under a key hashing what determines its result: the
+values of the train.py flags (all of them, besides those that only affect
+logging, devices and threads), the version of the dataset files
+(input_data.dataset_version), a fingerprint of the training source code and
+the seed. Changing the code or the data thus starts new runs, while
+relaunching a sweep finds the finished ones. Run from the command line, the
+mean test accuracy and its standard error are printed for every configuration
+in the store.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import scipy.stats as stats
+
+# modules train.py runs, their contents are part of every key
+SOURCES = ['train.py', 'model.py', 'layers.py', 'initializations.py', 'optimizer.py', 'preprocessing.py',
+           'input_data.py', 'prefetch.py', 'inference.py', 'planner.py']
+# train.py flags that do not change the result of a run (the seed is keyed separately)
+IGNORED_FLAGS = ['verbose', 'gpu', 'num_threads', 'save_dir', 'seeded', 'seed']
+
+def digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+def source_fingerprint(directory=None):
+    """Digest of the contents of SOURCES."""
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    fingerprint = hashlib.sha1()
+    for name in SOURCES:
+        with open(os.path.join(directory, name), 'rb') as f:
+            fingerprint.update(name.encode('utf-8') + b'\n' + f.read())
+    return fingerprint.hexdigest()
+
+def config_key(flags, dataset_version, source):
+    """Key of a configuration: train.py flag values, dataset version and source fingerprint."""
+    return digest([{name: value for name, value in flags.items() if name not in IGNORED_FLAGS},
+                   dataset_version, source])
+
+def run_key(config, seed):
+    return digest([config, seed])
+
+def summary(results):
+    """Mean test accuracy and its standard error over the runs that did not diverge, as train.py reports them."""
+    tests = np.array([result['test_acc'] for result in results])
+    tests = tests[tests > 0]
+    if not len(tests):
+        return float('nan'), float('nan')
+    return np.mean(tests), stats.sem(tests) if len(tests) > 1 else 0.
+
+class ResultStore(object):
+    """Results of runs, one JSON object per (configuration, seed)."""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (key TEXT PRIMARY KEY, config TEXT, seed INTEGER, '
+                        'flags TEXT, dataset_version TEXT, source TEXT, result TEXT, finished REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS runs_config ON runs (config)')
+        self.db.commit()
+
+    def get(self, key):
+        row = self.db.execute('SELECT result FROM runs WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, config, seed, flags, dataset_version, source, result):
+        self.db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (key, config, seed, json.dumps(flags, sort_keys=True), dataset_version, source,
+                         json.dumps(result, sort_keys=True), time.time()))
+        self.db.commit()
+
+    def results(self, config):
+        """Results of all stored seeds of a configuration."""
+        return [json.loads(row[0]) for row in
+                self.db.execute('SELECT result FROM runs WHERE config = ? ORDER BY seed', (config,))]
+
+    def configs(self):
+        """(config, flags) of every stored configuration, in the order they were first finished."""
+        return [(config, json.loads(flags)) for config, flags in
+                self.db.execute('SELECT config, flags FROM runs GROUP BY config ORDER BY MIN(finished)')]
+
+    def close(self):
+        self.db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sweep.db')
+    args = parser.parse_args()
+
+    store = ResultStore(args.db)
+    configs = store.configs()
+    names = sorted(set(name for _, flags in configs for name in flags))
+    varied = [name for name in names
+              if len(set(json.dumps(flags.get(name)) for _, flags in configs)) > 1 and name not in IGNORED_FLAGS]
+    print('{:>10} {:>6} {:>10} {:>10} {:>8}  {}'.format('config', 'runs', 'val_acc', 'test_acc', 'sem',
+                                                       ' '.join(varied)))
+    for config, flags in configs:
+        results = store.results(config)
+        test, sem = summary(results)
+        print('{:>10} {:>6} {:>10.5f} {:>10.5f} {:>8.5f}  {}'.format(
+            config[:10], len(results), np.mean([result['val_acc'] for result in results]), test, sem,
+            ' '.join('{}={}'.format(name, flags.get(name)) for name in varied)))
+    store.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Serve a model saved by train.py --save_dir over a local socket (Python 3).
+
+    python serve.py --model_dir saved/cora --port 8470
+    python serve.py --model_dir saved/cora --unix /tmp/gae.sock
+
+Requests and responses are JSON objects, one per line. Every request names an
+op and may carry an "id" that is echoed back:
+
+    {"op": "classify", "nodes": [0, 5]}         -> {"classes": [...], "probs": [[...], ...]}
+    {"op": "score", "pairs": [[0, 5], [2, 3]]}  -> {"scores": [...]}
+    {"op": "topk", "nodes": [0], "k": 10}       -> {"neighbors": [[...]], "scores": [[...]]}
+    {"op": "version"}                           -> {"version": ...}
+    {"op": "insert", "features": [[...], ...], "edges": [[0, 3327], ...]}
+                                                -> {"nodes": [...], "updated": ...}
+
+Answers come from the outputs cached by inference.Predictor. The graph manifest
+is polled and the forward pass only re-runs, in a worker thread, when its
+version changes. Inserted nodes (one feature row each, numbered after the
+existing ones) and edges update the cache around them in a worker thread and
+last until the next version of the graph on disk.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+
+from inference import Predictor
+
+def classify(predictor, request):
+    classes, probs = predictor.classify(request['nodes'])
+    return {'classes': classes.tolist(), 'probs': probs.tolist()}
+
+def score(predictor, request):
+    return {'scores': predictor.score(request['pairs']).tolist()}
+
+def topk(predictor, request):
+    neighbors, scores = predictor.topk(request['nodes'], int(request.get('k', 10)))
+    return {'neighbors': neighbors.tolist(), 'scores': scores.tolist()}
+
+def version(predictor, request):
+    return {'version': predictor.version}
+
+def insert(predictor, request):
+    nodes, updated = predictor.insert(request.get('features'), request.get('edges'))
+    return {'nodes': nodes.tolist(), 'updated': len(updated)}
+
+OPS = {'classify': classify, 'score': score, 'topk': topk, 'version': version, 'insert': insert}
+# ops running the model, answered from a worker thread
+BLOCKING = {'insert'}
+
+def encode(response):
+    return (json.dumps(response) + '\n').encode()
+
+def error(e):
+    return encode({'error': '{}: {}'.format(type(e).__name__, e)})
+
+def answer(predictor, request):
+    try:
+        response = OPS[request['op']](predictor, request)
+        if 'id' in request:
+            response['id'] = request['id']
+    except Exception as e:
+        return error(e)
+    return encode(response)
+
+async def handle(predictor, reader, writer):
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                blocking = request['op'] in BLOCKING
+            except Exception as e:
+                writer.write(error(e))
+            else:
+                if blocking:
+                    writer.write(await loop.run_in_executor(None, answer, predictor, request))
+                else:
+                    writer.write(answer(predictor, request))
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def poll(predictor, interval):
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if await loop.run_in_executor(None, predictor.refresh):
+                print('graph version {}: outputs recomputed'.format(predictor.version))
+        except Exception as e:
+            print('refresh failed: {}'.format(e), file=sys.stderr)
+
+async def serve(predictor, args):
+    def handler(reader, writer):
+        return handle(predictor, reader, writer)
+
+    if args.unix:
+        server = await asyncio.start_unix_server(handler, path=args.unix)
+    else:
+        server = await asyncio.start_server(handler, args.host, args.port)
+    print('serving {} (graph version {}) on {}'.format(args.model_dir, predictor.version,
+                                                       args.unix or '{}:{}'.format(args.host, args.port)))
+    sys.stdout.flush()
+    async with server:
+        await asyncio.gather(server.serve_forever(), poll(predictor, args.poll))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model_dir', required=True, help='directory given to train.py --save_dir')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8470)
+    parser.add_argument('--unix', default='', help='serve on this Unix socket instead of TCP')
+    parser.add_argument('--poll', type=float, default=1., help='seconds between checks of the graph version')
+    args = parser.parse_args()
+    asyncio.run(serve(Predictor(args.model_dir), args))
+
+if __name__ == '__main__':
+    main()
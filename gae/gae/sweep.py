@@ -0,0 +1,315 @@
+"""Hyperparameter sweep over the flags of train.py, run by a pool of worker processes.
+
+    python sweep.py --spec sweep.json --processes 4 --out sweep.csv
+
+The spec is a JSON object:
+
+    {"flags": {"dataset": "citeseer", "model": "graphite", "epochs": 200},
+     "grid": {"dim_z1": [16, 32], "dropout": [0.3, 0.5]},
+     "random": {"learning_rate": {"loguniform": [0.001, 0.05]},
+                "hidden_x": {"choice": [16, 32, 64]},
+                "tau": {"uniform": [0.5, 2.0]},
+                "num_head": {"randint": [4, 8]}},
+     "samples": 10,
+     "seeds": [1, 2, 3]}
+
+"flags" are fixed, every point of the "grid" is combined with "samples" draws
+of the "random" flags, and every configuration is trained once per seed (with
+--seeded 1 --seed S, --test_count 1 unless given). Each (configuration, seed)
+is a job: the workers import train.py once and run jobs one after another in a
+fresh TensorFlow graph, on datasets that are loaded and preprocessed once in
+this process before the workers are forked. Every finished job appends a row
+to the --out CSV table; a summary per configuration follows at the end.
+
+Finished jobs are kept in the SQLite store --db (see results.py). Jobs found
+there, with the same flag values, dataset files, training code and seed, are
+not run again, so a relaunched sweep resumes where it stopped, and the
+summary is computed from the store.
+
+With --scheduler asha, jobs are stopped early by asynchronous successive
+halving: at the rungs --min_epochs * eta**k (below --epochs of the job), a job
+goes on only if its best validation accuracy so far is in the top 1/eta of
+those that jobs reached earlier at the same rung, so processes move on to the
+next jobs instead of finishing poor configurations. The epochs and the
+estimated training time saved compared with running every job to the end are
+reported.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+import train
+from input_data import dataset_version
+from results import ResultStore, config_key, run_key, source_fingerprint, summary
+from train import FLAGS
+
+# train.py flags that select the data prepared by train.prepare_data()
+DATA_FLAGS = ['dataset', 'featureless', 'reduce_dim', 'reduce_method', 'reorder']
+METRICS = ['test_acc', 'val_acc', 'epoch', 'trained_epochs', 'sec_per_step', 'first_step', 'to_selected', 'peak_mb',
+           'loss', 'wall_sec', 'cached']
+
+def sample(dist, rng):
+    """One draw from {"choice": [...]}, {"uniform": [lo, hi]}, {"loguniform": [lo, hi]} or {"randint": [lo, hi]}."""
+    (kind, args), = dist.items()
+    if kind == 'choice':
+        return args[rng.randint(len(args))]
+    if kind == 'uniform':
+        return float(rng.uniform(*args))
+    if kind == 'loguniform':
+        return float(np.exp(rng.uniform(np.log(args[0]), np.log(args[1]))))
+    if kind == 'randint':
+        return int(rng.randint(args[0], args[1] + 1))
+    raise ValueError('Unknown distribution: ' + kind)
+
+def expand(spec, seed=0):
+    """Configurations (dicts of flag values) of a sweep spec."""
+    rng = np.random.RandomState(seed)
+    grid = spec.get('grid', {})
+    names = sorted(grid)
+    random_flags = spec.get('random', {})
+    configs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        for _ in range(spec.get('samples', 1) if random_flags else 1):
+            config = dict(spec.get('flags', {}))
+            config.update(zip(names, values))
+            config.update((name, sample(random_flags[name], rng)) for name in sorted(random_flags))
+            configs.append(config)
+    return configs
+
+class ASHA(object):
+    """Stopping rule of asynchronous successive halving, shared by the worker processes.
+
+    rungs (a multiprocessing.Manager dict) maps a rung epoch to the accuracies
+    reported there so far.
+    """
+    def __init__(self, min_epochs, eta, rungs, lock):
+        self.min_epochs = min_epochs
+        self.eta = eta
+        self.rungs = rungs
+        self.lock = lock
+
+    def is_rung(self, epoch, epochs):
+        rung = self.min_epochs
+        while rung < epoch:
+            rung *= self.eta
+        return rung == epoch and epoch < epochs
+
+    def keep(self, epoch, epochs, accuracy):
+        """Records accuracy after epoch (1-based) of a job of epochs; False if the job should stop."""
+        if not self.is_rung(epoch, epochs):
+            return True
+        with self.lock:
+            previous = self.rungs.get(epoch, [])
+            self.rungs[epoch] = previous + [accuracy]
+        return not previous or accuracy >= np.percentile(previous, 100. * (1 - 1. / self.eta))
+
+    def record(self, curve, epochs):
+        """Records the rung accuracies of the validation curve of a job finished earlier."""
+        for epoch in range(1, len(curve) + 1):
+            if self.is_rung(epoch, epochs):
+                with self.lock:
+                    self.rungs[epoch] = self.rungs.get(epoch, []) + [max(curve[:epoch])]
+
+# scheduler of the jobs of a worker process, set by init_worker()
+_scheduler = None
+
+def init_worker(scheduler):
+    global _scheduler
+    _scheduler = scheduler
+
+def configure(config):
+    """Resets the train.py flags to their defaults and applies config."""
+    for flag in train.train_flags():
+        flag.unparse()
+    for name, value in config.items():
+        FLAGS[name].parse(str(value))
+
+def resolve(config):
+    """Values of all train.py flags under config."""
+    return {flag.name: flag.parser.parse(str(config[flag.name])) if flag.name in config else flag.default
+            for flag in train.train_flags()}
+
+def data_key(config):
+    return tuple(config.get(name, FLAGS[name].default) for name in DATA_FLAGS)
+
+def planned_subsample(values):
+    """--subsample the runs of resolved flag values train with, as train.plan_run chooses it."""
+    if not values['plan'] or values['memory_budget_gb'] <= 0:
+        return values['subsample']
+    try:
+        return train.plan_run(argparse.Namespace(**values), train.prepare_data(*data_key(values)))[0]
+    except MemoryError:
+        # the jobs fail and nothing is stored
+        return values['subsample']
+
+def run_job(job):
+    """Trains one (configuration, seed) in a worker; returns its table row."""
+    config_id, config, seed = job
+    configure(dict(config, seeded=1, seed=seed, verbose=0))
+    row = {'config': config_id, 'seed': seed, 'error': '', 'cached': 0}
+    callback = None
+    if _scheduler is not None:
+        best = {}
+        def callback(run, epoch, accuracy):
+            best[run] = max(best.get(run, -np.inf), accuracy)
+            return _scheduler.keep(epoch + 1, FLAGS.epochs, best[run])
+    start = time.time()
+    try:
+        results = train.train(callback)
+    except Exception as e:
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+        results = None
+    row['wall_sec'] = time.time() - start
+    if results is not None:
+        valid = results['test_acc'] > 0
+        row.update({'test_acc': np.mean(results['test_acc'][valid]) if valid.any() else -1.,
+                    'val_acc': np.mean(results['val_acc']), 'epoch': np.mean(results['epoch']),
+                    'trained_epochs': np.mean(results['trained_epochs']),
+                    'sec_per_step': np.mean(results['step_time']),
+                    'first_step': np.mean(results['first_step_time']),
+                    'to_selected': np.mean(results['selected_time']),
+                    'peak_mb': results['peak_memory'][0] / 2.**20,
+                    'loss': 'sampled' if results['subsample'] else 'dense',
+                    'val_curves': [[float(val) for val in curve] for curve in results['val_curves']]})
+    sys.stdout.flush()
+    return row
+
+def summarize(store, keys, seeds, configs, varied):
+    """Mean validation and test accuracy and epochs trained over the stored seeds of every configuration, best
+    validation first."""
+    print('{:>6} {:>6} {:>7} {:>10} {:>10} {:>8}  {}'.format('config', 'seeds', 'epochs', 'val_acc', 'test_acc',
+                                                             'sem', ' '.join(varied)))
+    rows = []
+    for config_id, key in enumerate(keys):
+        done = [result for result in (store.get(run_key(key, seed)) for seed in seeds) if result is not None]
+        if not done:
+            continue
+        test, sem = summary(done)
+        rows.append((np.mean([result['val_acc'] for result in done]), test, sem, len(done),
+                     np.mean([result['trained_epochs'] for result in done]), config_id))
+    for val, test, sem, count, epochs, config_id in sorted(rows, reverse=True):
+        print('{:>6} {:>6} {:>7.0f} {:>10.5f} {:>10.5f} {:>8.5f}  {}'.format(
+            config_id, count, epochs, val, test, sem, ' '.join('{}={}'.format(name, configs[config_id].get(name))
+                                                       for name in varied)))
+
+def report_savings(rows, configs):
+    """Epochs and estimated training time saved by stopping jobs early, compared with running them all."""
+    done = [row for row in rows if not row['error']]
+    planned = [configs[row['config']].get('epochs', FLAGS['epochs'].default) for row in done]
+    trained = sum(row['trained_epochs'] for row in done)
+    saved_sec = sum((epochs - row['trained_epochs']) * row['sec_per_step'] for epochs, row in zip(planned, done))
+    stopped = sum(row['trained_epochs'] < epochs for epochs, row in zip(planned, done))
+    print('asha stopped {} of {} jobs early: trained {:.0f} of {} epochs ({:.0%} saved), about {:.1f} sec of '
+          'training saved'.format(stopped, len(done), trained, sum(planned), 1 - trained / max(sum(planned), 1),
+                                  saved_sec))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--spec', required=True, help='JSON sweep spec')
+    parser.add_argument('--out', default='sweep.csv', help='CSV table with one row per (configuration, seed)')
+    parser.add_argument('--db', default='sweep.db', help='SQLite store of finished jobs')
+    parser.add_argument('--processes', type=int, default=max(multiprocessing.cpu_count() // 2, 1))
+    parser.add_argument('--threads', type=int, default=0,
+                        help='TensorFlow threads per job (0 to share the cores between the processes)')
+    parser.add_argument('--sample_seed', type=int, default=0, help='seed of the random search draws')
+    parser.add_argument('--scheduler', default='none', choices=['none', 'asha'])
+    parser.add_argument('--min_epochs', type=int, default=20, help='first rung of asha')
+    parser.add_argument('--eta', type=int, default=3, help='asha keeps the top 1/eta of the jobs at every rung')
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    # parse no command line flags, only the spec sets them
+    FLAGS([sys.argv[0]])
+    names = set(flag.name for flag in train.train_flags())
+    configs = expand(spec, args.sample_seed)
+    for config in configs:
+        unknown = set(config) - names
+        if unknown:
+            raise ValueError('Unknown train.py flags: ' + ', '.join(sorted(unknown)))
+        config.setdefault('test_count', 1)
+        config.setdefault('num_threads', args.threads or max(multiprocessing.cpu_count() // args.processes, 1))
+    seeds = spec.get('seeds', [123])
+    jobs = [(config_id, config, seed) for config_id, config in enumerate(configs) for seed in seeds]
+    flag_names = sorted(set(name for config in configs for name in config))
+    varied = [name for name in flag_names if len(set(str(config.get(name)) for config in configs)) > 1]
+
+    # load and preprocess every dataset once, before the workers are forked so they share it
+    start = time.time()
+    for key in sorted(set(data_key(config) for config in configs)):
+        train.prepare_data(*key)
+    print('{} configurations, {} jobs on {} processes; data prepared in {:.1f} sec'.format(
+        len(configs), len(jobs), args.processes, time.time() - start))
+    sys.stdout.flush()
+
+    scheduler = None
+    if args.scheduler == 'asha':
+        manager = multiprocessing.Manager()
+        scheduler = ASHA(args.min_epochs, args.eta, manager.dict(), manager.Lock())
+
+    # jobs finished earlier: stopped ones count only when stopping is allowed
+    store = ResultStore(args.db)
+    source = source_fingerprint()
+    # keyed with the loss the planner picks for them, which is the one their jobs train with
+    flags = [dict(values, subsample=planned_subsample(values)) for values in (resolve(config) for config in configs)]
+    versions = dict((values['dataset'], dataset_version(values['dataset'])) for values in flags)
+    keys = [config_key(values, versions[values['dataset']], source) for values in flags]
+    rows, pending = [], []
+    for config_id, config, seed in jobs:
+        result = store.get(run_key(keys[config_id], seed))
+        if result is not None and (scheduler is not None or result['trained_epochs'] >= flags[config_id]['epochs']):
+            rows.append(dict(result, config=config_id, seed=seed, cached=1))
+            if scheduler is not None:
+                for curve in result['val_curves']:
+                    scheduler.record(curve, flags[config_id]['epochs'])
+        else:
+            pending.append((config_id, config, seed))
+    print('{} jobs found in {}, {} to run'.format(len(rows), args.db, len(pending)))
+    sys.stdout.flush()
+
+    start = time.time()
+    pool = multiprocessing.Pool(args.processes, init_worker, (scheduler,))
+    with open(args.out, 'w') as f:
+        writer = csv.DictWriter(f, ['config', 'seed'] + flag_names + METRICS + ['error'], lineterminator='\n',
+                                extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(configs[row['config']], **row))
+        for row in pool.imap_unordered(run_job, pending):
+            rows.append(row)
+            writer.writerow(dict(configs[row['config']], **row))
+            f.flush()
+            if not row['error']:
+                config_id = row['config']
+                result = dict((name, value) for name, value in row.items() if name not in ['config', 'cached'])
+                store.put(run_key(keys[config_id], row['seed']), keys[config_id], row['seed'],
+                          flags[config_id], versions[flags[config_id]['dataset']], source, result)
+            if row['error']:
+                status = row['error']
+            else:
+                status = 'val_acc {:.5f} test_acc {:.5f}'.format(row['val_acc'], row['test_acc'])
+            print('[{}/{}] config {} seed {}: {} ({:.1f} sec)'.format(len(rows), len(jobs), row['config'],
+                                                                       row['seed'], status, row['wall_sec']))
+            sys.stdout.flush()
+    pool.close()
+    pool.join()
+
+    print('{} jobs in {:.1f} sec ({:.1f} sec of jobs)'.format(len(pending), time.time() - start,
+                                                             sum(row['wall_sec'] for row in rows if not row['cached'])))
+    if scheduler is not None:
+        report_savings(rows, configs)
+    summarize(store, keys, seeds, configs, varied)
+    store.close()
+
+if __name__ == '__main__':
+    main()
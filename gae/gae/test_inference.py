@@ -0,0 +1,78 @@
+"""Regression tests of inference.Predictor on a small graph saved by train.py --save_dir.
+
+    python -m pytest test_inference.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.sparse as sp
+
+import train
+from inference import Predictor
+from input_data import save_graph
+from preprocessing import sparse_to_tuple
+from train import FLAGS
+
+NUM_NODES = 30
+NUM_FEATURES = 20
+# isolated node whose feature row has a single nonzero, so its 2-hop subgraph looks one-hot
+SINGLE = 5
+
+def sparse_graph(path):
+    """A graph with bag-of-words like features (three nonzeros per row, one for SINGLE)."""
+    rng = np.random.RandomState(0)
+    edges = rng.randint(NUM_NODES, size=(60, 2))
+    edges = edges[(edges[:, 0] != edges[:, 1]) & (edges != SINGLE).all(1)]
+    adj = sp.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(NUM_NODES, NUM_NODES))
+    adj = ((adj + adj.T) > 0).astype(np.float32)
+    rows = np.repeat(np.arange(NUM_NODES), 3)
+    cols = np.concatenate([rng.choice(NUM_FEATURES, 3, replace=False) for _ in range(NUM_NODES)])
+    features = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(NUM_NODES, NUM_FEATURES))
+    features = sp.lil_matrix(features)
+    features[SINGLE, :] = 0
+    features[SINGLE, 0] = 1
+    labels = rng.randint(3, size=NUM_NODES)
+    save_graph(path, adj, sp.csr_matrix(features), labels, np.arange(10), np.arange(10, 20), np.arange(20, 30))
+
+class SparseFeaturePredictorTest(unittest.TestCase):
+    """A model fed sparse features, queried on subgraphs whose rows are all single nonzeros."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        graph_dir = os.path.join(cls.tmp, 'graph')
+        cls.save_dir = os.path.join(cls.tmp, 'saved')
+        sparse_graph(graph_dir)
+        FLAGS(['test_inference'])
+        for flag in train.train_flags():
+            flag.unparse()
+        for name, value in [('dataset', graph_dir), ('model', 'gcn'), ('epochs', 2), ('test_count', 1),
+                            ('verbose', 0), ('plan', 0), ('seeded', 1), ('save_dir', cls.save_dir)]:
+            FLAGS[name].parse(str(value))
+        train.train()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp)
+
+    def test_forward_nodes_single_nonzero(self):
+        predictor = Predictor(self.save_dir)
+        self.assertIsNone(predictor.placeholders['feature_index'])
+        logits, emb = predictor.forward_nodes([SINGLE])
+        np.testing.assert_allclose(logits[0], predictor.logits[SINGLE], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(emb[0], predictor.emb[SINGLE], rtol=1e-5, atol=1e-6)
+
+    def test_insert_single_nonzero(self):
+        predictor = Predictor(self.save_dir)
+        row = sp.csr_matrix(([1.], ([0], [3])), shape=(1, NUM_FEATURES))
+        new_nodes, _ = predictor.insert(features=row)
+        adj_norm, features = predictor.graph_inputs
+        logits, _ = predictor.forward(sparse_to_tuple(adj_norm), features, np.arange(adj_norm.shape[0]))
+        np.testing.assert_allclose(predictor.logits[new_nodes], logits[new_nodes], rtol=1e-5, atol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
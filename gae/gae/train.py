@@ -11,17 +11,13 @@ import numpy as np
 import scipy.sparse as sp
 import scipy.stats as stats
 
-from sklearn.metrics import roc_auc_score
-from sklearn.metrics import average_precision_score
-from sklearn.preprocessing import normalize
-
-from sklearn import manifold
-from scipy.special import expit
-
 from optimizer import *
 from input_data import *
 from model import *
 from preprocessing import *
+from prefetch import Prefetcher
+from inference import Exporter
+from planner import GB, available_memory, plan
 
 # Settings
 flags = tf.app.flags
@@ -58,137 +54,357 @@ flags.DEFINE_string('dataset', 'cora', 'Dataset string.')
 flags.DEFINE_string('model', 'graphite', 'Model string.')
 flags.DEFINE_integer('gpu', -1, 'Which gpu to use')
 flags.DEFINE_integer('seeded', 0, 'Set numpy random seed')
+flags.DEFINE_integer('seed', 123, 'Numpy and TensorFlow random seed used with --seeded')
+flags.DEFINE_integer('num_threads', 0, 'TensorFlow intra- and inter-op threads (0 for one per core)')
 
 flags.DEFINE_integer('attention', 0, 'attention model')
-
-dataset_str = FLAGS.dataset
-model_str = FLAGS.model
-
-if FLAGS.seeded:
-    np.random.seed(123)
-    tf.set_random_seed(123)
-
-runs = np.zeros(FLAGS.test_count)
-for run in range(FLAGS.test_count):
+flags.DEFINE_integer('prefetch', 0, 'Background threads preparing the next epochs inputs (0 to prepare them inline)')
+flags.DEFINE_integer('prefetch_depth', 2, 'Number of prepared epochs kept ahead of training')
+flags.DEFINE_integer('fused_spmm', 1, 'Share one adjacency product between parallel graph convolutions')
+flags.DEFINE_integer('share_input_branch', 0, 'Compute the input feature branch of encoder_y once per step (shares its dropout mask)')
+flags.DEFINE_integer('featureless', 0, 'Use identity features instead of the dataset features')
+flags.DEFINE_integer('reduce_dim', 0, 'Reduce the features to this many dense columns (0 to keep them)')
+flags.DEFINE_string('reduce_method', 'projection', 'Feature reduction: projection or svd')
+flags.DEFINE_string('reorder', 'none', 'Node reordering applied after loading: none, rcm, degree or bfs')
+flags.DEFINE_integer('xla', 0, 'Compile the dense parts of the forward and backward pass with XLA')
+flags.DEFINE_integer('grad_accum', 1, 'Micro-batches whose gradients are accumulated before each Adam step')
+flags.DEFINE_integer('num_samples', 1, 'Latent samples per step, computed as one batch and averaged in the loss')
+flags.DEFINE_string('save_dir', '', 'Save the model of the first run and its graph here for inference.py / serve.py')
+flags.DEFINE_integer('plan', 1, 'Estimate the memory of a run before building it and stop if it does not fit')
+flags.DEFINE_float('memory_budget_gb', 0., 'Memory budget of the planner in GB, under which it may switch to the sampled loss (0 for the memory available, without switching)')
+flags.DEFINE_string('recompute', '', 'Comma separated blocks recomputed on the backward pass: encoder_z1, decoder_x, latent')
+flags.DEFINE_integer('measure_memory', 0, 'Trace one extra forward and backward pass after the first run to measure its peak memory')
+
+def train_flags():
+    """Flags defined in this script (not those of absl or TensorFlow)."""
+    # flags of a script run directly are registered under its path
+    return FLAGS.get_key_flags_for_module(sys.argv[0] if __name__ == '__main__' else __name__)
+
+def flag_values():
+    return {flag.name: flag.value for flag in train_flags()}
+
+def peak_memory(sess, fetches, feed_dict):
+    """Peak bytes allocated by TensorFlow while running fetches once, from the allocation records of a traced run."""
+    run_metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, run_metadata=run_metadata,
+             options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE))
+    records = sorted((record.alloc_micros, record.alloc_bytes)
+                     for device in run_metadata.step_stats.dev_stats
+                     for node in device.node_stats
+                     for memory in node.memory
+                     for record in memory.allocation_records)
+    if not records:
+        return 0
+    return max(np.max(np.cumsum([alloc_bytes for _, alloc_bytes in records])), 0)
+
+def plan_run(flags, data):
+    """Planner estimate of a run with flags (FLAGS or any object with their values) on prepared data.
+
+    Returns (subsample, estimate), where subsample is the loss the run trains
+    with. The planner replaces the dense reconstruction loss by the sampled one
+    only under an explicit --memory_budget_gb, so that flag values alone
+    decide the objective; against the memory available, which depends on the
+    load of the machine, a run that does not fit stops instead. Raises
+    MemoryError when the run does not fit its budget.
+    """
+    explicit = flags.memory_budget_gb > 0
+    adj = data['adj']
+    return plan(flags, adj.shape[0], adj.nnz, data['num_features'], data['features_nonzero'],
+                data['labels'][0].shape[1], isinstance(data['features'], np.ndarray),
+                flags.memory_budget_gb * GB if explicit else available_memory(), switch=explicit)
+
+# prepared datasets by (dataset, featureless, reduce_dim, reduce_method, reorder)
+_prepared = {}
+
+def prepare_data(dataset_str, featureless=0, reduce_dim=0, reduce_method='projection', reorder='none', verbose=0):
+    """Loads a dataset and computes the inputs that do not depend on the model flags.
+
+    Results are cached per process, so repeated calls (every run of train() and
+    every job of a sweep) share them; processes forked after a call share the
+    arrays as well.
+    """
+    key = (dataset_str, featureless, reduce_dim, reduce_method, reorder)
+    if key in _prepared:
+        return _prepared[key]
 
     adj, features, y_train, y_val, y_test, train_mask, val_mask, test_mask = load_data(dataset_str)
-    adj_def = adj
+
+    if reduce_dim > 0 and not featureless:
+        cache_dir = find_graph(dataset_str) or 'data'
+        cache_prefix = os.path.join(cache_dir, os.path.basename(os.path.normpath(dataset_str)))
+        features = cached_reduce_features(features, reduce_dim, reduce_method, cache_prefix,
+                                          dataset_version(dataset_str))
+
+    # saved with the model: the graph in its original node order (with perm), features as the model takes them
+    served_graph = (adj, None if featureless else features, y_train + y_val + y_test,
+                    np.where(train_mask)[0], np.where(val_mask)[0], np.where(test_mask)[0])
+
+    # node i of the trained graph is node perm[i] of the loaded one (None without --reorder)
+    perm = None
+    if reorder != 'none':
+        span, seconds = edge_span(adj), spmm_seconds(adj) if verbose else None
+        perm = node_ordering(adj, reorder)
+        adj, features, y_train, y_val, y_test, train_mask, val_mask, test_mask = permute_nodes(
+            perm, adj, features, y_train, y_val, y_test, train_mask, val_mask, test_mask)
+        if verbose:
+            print("Reordered nodes ({}): mean edge span {:.1f} -> {:.1f}, SpMM {:.2f} -> {:.2f} ms".format(
+                reorder, span, edge_span(adj), 1e3 * seconds, 1e3 * spmm_seconds(adj)))
 
     adj_norm = preprocess_graph(adj)
     adj_label = adj + sp.eye(adj.shape[0])
     adj_label = sparse_to_tuple(adj_label)
 
-    features = preprocess_features(features)
-    num_features = features[2][1]
-    features_nonzero = features[1].shape[0]
-    # Define placeholders
-    placeholders = {
-        'features': tf.sparse_placeholder(tf.float32),
-        'adj': tf.sparse_placeholder(tf.float32),
-        'adj_orig': tf.sparse_placeholder(tf.float32),
-        'dropout': tf.placeholder_with_default(0., shape=()),
-        'labels': tf.placeholder(tf.float32, shape=(None, y_train.shape[1])),
-        'labels_mask': tf.placeholder(tf.int32),
-    }
-
-    num_nodes = adj.shape[0]
-
-    # Create model
-    model = None
-    if model_str == 'graphite' or model_str == 'graphite_kingma':
-        model = GCNModelFeedback(placeholders, num_features, num_nodes, features_nonzero)
-    else:
-        model = GCNModel(placeholders, num_features, num_nodes, features_nonzero)
-
-    pos_weight = float(adj.shape[0] * adj.shape[0] - adj.sum()) / adj.sum()
-    norm = adj.shape[0] * adj.shape[0] / float((adj.shape[0] * adj.shape[0] - adj.sum()) * 2)
-
-    # Optimizer
-    with tf.name_scope('optimizer'):
-        opt = None
-        if model_str == 'graphite':
-            opt = OptimizerSemi(preds=model.reconstructions,
-                           labels=placeholders['adj_orig'],
-                           model=model, num_nodes=num_nodes,
-                           pos_weight=pos_weight,
-                           norm=norm)
-        elif model_str == 'graphite_kingma':
-            opt = OptimizerSemiGen(preds=model.reconstructions,
-                           labels=placeholders['adj_orig'],
-                           model=model, num_nodes=num_nodes,
-                           pos_weight=pos_weight,
-                           norm=norm)        
-        else:
-            opt = OptimizerSuper(model = model)
-
-    os.environ['TF_CPP_MIN_LOG_LEVEL']='2'
-    if FLAGS.gpu == -1:
-        os.environ['CUDA_VISIBLE_DEVICES'] = ''
-        sess = tf.Session()
-    else:
-        os.environ['CUDA_VISIBLE_DEVICES'] = str(FLAGS.gpu) # Or whichever device you would like to use
-        gpu_options = tf.GPUOptions(allow_growth=True)
-        sess = tf.Session(config=tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=True))
-    sess.run(tf.global_variables_initializer())
-
-    vals = np.zeros(FLAGS.epochs)
-    tests = np.zeros(FLAGS.epochs)
-
-    avg_cost = 0
-    # Train model
-    for epoch in range(FLAGS.epochs):
-
-        if FLAGS.edge_dropout > 0:
-            adj_train_mini = edge_dropout(adj, FLAGS.edge_dropout)
-            adj_norm_mini = preprocess_graph(adj_train_mini)
+    # Identity and one-hot features are looked up by index instead of being fed,
+    # dense (e.g. reduced) features are fed as they are
+    features, feature_index, num_features, features_nonzero = model_inputs(features, featureless, adj.shape[0])
+
+    _prepared[key] = data = {
+        'adj': adj, 'adj_norm': adj_norm, 'adj_label': adj_label, 'features': features,
+        'feature_index': feature_index, 'num_features': num_features, 'features_nonzero': features_nonzero,
+        'labels': (y_train, y_val, y_test), 'masks': (train_mask, val_mask, test_mask), 'served_graph': served_graph,
+        'perm': perm}
+    return data
+
+def train(epoch_callback=None):
+    """Trains --test_count models with the current flag values in a fresh graph.
+
+    epoch_callback(run, epoch, val_accuracy) is called after every epoch; a
+    run stops early when it returns False. Returns per run arrays: test
+    accuracy at the selected epoch (-1 for runs that diverged), validation
+    accuracy and number of that epoch, epochs trained, seconds per training
+    step, for the first step and until the selected epoch, and peak memory in
+    bytes (measured on the first run with --measure_memory, nan otherwise), as
+    well as the validation accuracy of every epoch of every run and, as
+    'subsample', the reconstruction loss the runs trained with (see plan_run).
+    """
+    dataset_str = FLAGS.dataset
+    model_str = FLAGS.model
+
+    tf.reset_default_graph()
+    if FLAGS.seeded:
+        np.random.seed(FLAGS.seed)
+        tf.set_random_seed(FLAGS.seed)
+
+    data = prepare_data(dataset_str, FLAGS.featureless, FLAGS.reduce_dim, FLAGS.reduce_method, FLAGS.reorder,
+                        FLAGS.verbose)
+    adj, adj_norm, adj_label = data['adj'], data['adj_norm'], data['adj_label']
+    features, feature_index = data['features'], data['feature_index']
+    num_features, features_nonzero = data['num_features'], data['features_nonzero']
+    y_train, y_val, y_test = data['labels']
+    train_mask, val_mask, test_mask = data['masks']
+
+    subsample = FLAGS.subsample
+    if FLAGS.plan:
+        subsample, estimate = plan_run(FLAGS, data)
+        if subsample != FLAGS.subsample:
+            print("Planner: the dense reconstruction loss does not fit in {:.1f} GB, using --subsample {}".format(
+                FLAGS.memory_budget_gb, subsample))
+        if FLAGS.verbose:
+            print("Planner: {:.2f} GB and {:.2f} GFLOP per training step".format(estimate['memory'] / GB,
+                                                                                 estimate['flops'] / 1e9))
+
+    runs = np.zeros(FLAGS.test_count)
+    selected_vals = np.zeros(FLAGS.test_count)
+    selected_epochs = np.zeros(FLAGS.test_count, dtype=np.int64)
+    trained_epochs = np.zeros(FLAGS.test_count, dtype=np.int64)
+    val_curves = []
+    step_times = np.zeros(FLAGS.test_count)
+    first_step_times = np.zeros(FLAGS.test_count)
+    peak_memories = np.full(FLAGS.test_count, np.nan)
+    selected_times = np.zeros(FLAGS.test_count)
+    for run in range(FLAGS.test_count):
+
+        # Define placeholders
+        placeholders = {
+            'adj': tf.sparse_placeholder(tf.float32),
+            'adj_orig': tf.sparse_placeholder(tf.float32),
+            'dropout': tf.placeholder_with_default(0., shape=()),
+            'labels': tf.placeholder(tf.float32, shape=(None, y_train.shape[1])),
+            'labels_mask': tf.placeholder(tf.int32),
+        }
+        if isinstance(features, np.ndarray):
+            placeholders['features'] = tf.placeholder(tf.float32, shape=(None, num_features))
+        elif feature_index is None:
+            placeholders['features'] = tf.sparse_placeholder(tf.float32)
+        elif FLAGS.featureless:
+            placeholders['feature_index'] = tf.placeholder_with_default(tf.range(adj.shape[0], dtype=tf.int64), shape=[None])
         else:
-            adj_norm_mini = adj_norm
-
-        feed_dict = construct_feed_dict(adj_norm_mini, adj_label, features, y_train, train_mask, placeholders)
-        feed_dict.update({placeholders['dropout']: FLAGS.dropout})
+            placeholders['feature_index'] = tf.placeholder_with_default(tf.constant(feature_index), shape=[None])
 
-        # checks = sess.run([opt.A, opt.B], feed_dict=feed_dict)
-        # np.set_printoptions(threshold=np.nan)
-        # print(checks)
+        num_nodes = adj.shape[0]
 
-        outs = sess.run([opt.opt_op, opt.cost, opt.accuracy], feed_dict=feed_dict)
-        avg_cost = outs[1]
-        avg_accuracy = outs[2]
-
-        feed_dict = construct_feed_dict(adj_norm, adj_label, features, y_val, val_mask, placeholders)
-        feed_dict.update({placeholders['dropout']: 0.})
-        outs = sess.run([opt.cost, opt.accuracy], feed_dict=feed_dict)
-        val_accuracy = outs[1]
-
-        feed_dict = construct_feed_dict(adj_norm, adj_label, features, y_test, test_mask, placeholders)
-        feed_dict.update({placeholders['dropout']: 0.})
-        outs = sess.run([opt.cost, opt.accuracy], feed_dict=feed_dict)
-        test_accuracy = outs[1]
-
-        vals[epoch] = val_accuracy
-        tests[epoch] = test_accuracy
+        # Create model
+        model = None
+        if model_str == 'graphite' or model_str == 'graphite_kingma':
+            model = GCNModelFeedback(placeholders, num_features, num_nodes, features_nonzero)
+        else:
+            model = GCNModel(placeholders, num_features, num_nodes, features_nonzero)
+
+        pos_weight = float(adj.shape[0] * adj.shape[0] - adj.sum()) / adj.sum()
+        norm = adj.shape[0] * adj.shape[0] / float((adj.shape[0] * adj.shape[0] - adj.sum()) * 2)
+
+        # Optimizer
+        with tf.name_scope('optimizer'):
+            opt = None
+            if model_str == 'graphite':
+                opt = OptimizerSemi(preds=model.reconstructions,
+                               labels=placeholders['adj_orig'],
+                               model=model, num_nodes=num_nodes,
+                               pos_weight=pos_weight,
+                               norm=norm, subsample=subsample)
+            elif model_str == 'graphite_kingma':
+                opt = OptimizerSemiGen(preds=model.reconstructions,
+                               labels=placeholders['adj_orig'],
+                               model=model, num_nodes=num_nodes,
+                               pos_weight=pos_weight,
+                               norm=norm, subsample=subsample)
+            else:
+                opt = OptimizerSuper(model = model)
+
+        exporter = None
+        if FLAGS.save_dir and run == 0:
+            exporter = Exporter(FLAGS.save_dir, model, placeholders)
+            exporter.save_graph(*data['served_graph'], name=dataset_str, perm=data['perm'])
+
+        os.environ['TF_CPP_MIN_LOG_LEVEL']='2'
+        config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.num_threads,
+                                inter_op_parallelism_threads=FLAGS.num_threads)
+        if FLAGS.gpu == -1:
+            os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        else:
+            os.environ['CUDA_VISIBLE_DEVICES'] = str(FLAGS.gpu) # Or whichever device you would like to use
+            config.gpu_options.allow_growth = True
+            config.allow_soft_placement = True
+        sess = tf.Session(config=config)
+        sess.run(tf.global_variables_initializer())
+
+        vals = np.zeros(FLAGS.epochs)
+        best_val = -np.inf
+        tests = np.zeros(FLAGS.epochs)
+        epoch_times = np.zeros(FLAGS.epochs)
+
+        def train_feed(epoch, rng):
+            if FLAGS.edge_dropout > 0:
+                adj_train_mini = edge_dropout(adj, FLAGS.edge_dropout, rng)
+                adj_norm_mini = preprocess_graph(adj_train_mini)
+            else:
+                adj_norm_mini = adj_norm
+
+            feed_dict = construct_feed_dict(adj_norm_mini, adj_label, features, y_train, train_mask, placeholders)
+            feed_dict.update({placeholders['dropout']: FLAGS.dropout})
+            return feed_dict
+
+        # every step averages the gradients of micro_batches training feeds
+        micro_batches = max(FLAGS.grad_accum, 1)
+        num_feeds = FLAGS.epochs * micro_batches
+        if FLAGS.prefetch > 0:
+            train_feeds = iter(Prefetcher(train_feed, num_feeds, FLAGS.prefetch, FLAGS.prefetch_depth))
+        else:
+            train_feeds = (train_feed(i, np.random) for i in range(num_feeds))
+
+        val_feed_dict = construct_feed_dict(adj_norm, adj_label, features, y_val, val_mask, placeholders)
+        val_feed_dict.update({placeholders['dropout']: 0.})
+        test_feed_dict = construct_feed_dict(adj_norm, adj_label, features, y_test, test_mask, placeholders)
+        test_feed_dict.update({placeholders['dropout']: 0.})
+
+        avg_cost = 0
+        # Train model
+        for epoch in range(FLAGS.epochs):
+            feeds = [next(train_feeds) for _ in range(micro_batches)]
+
+            # checks = sess.run([opt.A, opt.B], feed_dict=feed_dict)
+            # np.set_printoptions(threshold=np.nan)
+            # print(checks)
+
+            t = time.time()
+            if micro_batches == 1:
+                outs = sess.run([opt.opt_op, opt.cost, opt.accuracy], feed_dict=feeds[0])[1:]
+            else:
+                sess.run(opt.zero_op)
+                outs = np.mean([sess.run([opt.accumulate_op, opt.cost, opt.accuracy], feed_dict=feed_dict)[1:]
+                                for feed_dict in feeds], axis=0)
+                sess.run(opt.apply_op)
+            epoch_times[epoch] = time.time() - t
+            avg_cost = outs[0]
+            avg_accuracy = outs[1]
+
+            outs = sess.run([opt.cost, opt.accuracy], feed_dict=val_feed_dict)
+            val_accuracy = outs[1]
+
+            outs = sess.run([opt.cost, opt.accuracy], feed_dict=test_feed_dict)
+            test_accuracy = outs[1]
+
+            vals[epoch] = val_accuracy
+            tests[epoch] = test_accuracy
+
+            # keep the model of the epoch whose test accuracy is reported
+            if exporter is not None and (val_accuracy > best_val or not FLAGS.pick_best and epoch == FLAGS.epochs - 1):
+                exporter.save(sess, model_str, FLAGS.featureless, dataset=dataset_str, epoch=epoch + 1,
+                              val_acc=float(val_accuracy), test_acc=float(test_accuracy), flags=flag_values())
+            best_val = max(best_val, val_accuracy)
+
+            if FLAGS.verbose:
+                print("Epoch:", '%04d' % (epoch + 1), "train_loss=", "{:.5f}".format(avg_cost),
+                      "train_acc=", "{:.5f}".format(avg_accuracy), "val_acc=", "{:.5f}".format(val_accuracy),
+                      "train_time=", "{:.2f}".format(np.sum(epoch_times[:epoch + 1])))
+
+            if epoch_callback is not None and not epoch_callback(run, epoch, val_accuracy):
+                break
+
+        train_feeds.close()
+        trained_epochs[run] = epoch + 1
+        vals, tests, epoch_times = vals[:epoch + 1], tests[:epoch + 1], epoch_times[:epoch + 1]
+        val_curves.append(vals)
+
+        if FLAGS.pick_best:
+            arg = np.nanargmax(vals)
+        else:
+            arg = epoch
+        runs[run] = tests[arg]
+        selected_vals[run] = vals[arg]
+        selected_epochs[run] = arg + 1
+        # the first step includes graph optimization and XLA compilation
+        first_step_times[run] = epoch_times[0]
+        # training time until the epoch whose test accuracy is reported
+        selected_times[run] = np.sum(epoch_times[:arg + 1])
+        if FLAGS.measure_memory and run == 0:
+            # forward and backward pass without applying the gradients
+            peak_memories[run] = peak_memory(sess, [g for g, v in opt.grads_vars if g is not None], feeds[-1])
+        step_times[run] = np.mean(epoch_times[1:epoch + 1]) if epoch > 0 else epoch_times[0]
+        if np.isnan(avg_cost):
+            runs[run] = -1
+        if FLAGS.verbose or FLAGS.dataset == 'pubmed':
+            print(arg)
+            print(tests[arg])
+        if FLAGS.verbose:
+            print("first step:", "{:.5f}".format(first_step_times[run]), "sec, later steps:", "{:.5f}".format(step_times[run]), "sec")
+            if FLAGS.measure_memory:
+                print("peak memory:", "{:.1f}".format(peak_memories[run] / 2.**20), "MB")
+            sys.stdout.flush()
 
+        sess.close()
         if FLAGS.verbose:
-            print("Epoch:", '%04d' % (epoch + 1), "train_loss=", "{:.5f}".format(avg_cost),
-                  "train_acc=", "{:.5f}".format(avg_accuracy), "val_acc=", "{:.5f}".format(val_accuracy))
-
-    if FLAGS.pick_best:
-        arg = np.nanargmax(vals)
-    else:
-        arg = FLAGS.epochs - 1
-    runs[run] = tests[arg]
-    if np.isnan(avg_cost):
-        runs[run] = -1
-    if FLAGS.verbose or FLAGS.dataset == 'pubmed':
-        print(arg)
-        print(tests[arg])
-        sys.stdout.flush()
-    if FLAGS.verbose:    
-        break
-
-    sess.close()
-
-if not FLAGS.verbose:
-    print(runs)
-    runs = runs[runs > 0]
-    print((np.mean(runs), stats.sem(runs)))
+            break
+
+    return {'test_acc': runs, 'val_acc': selected_vals, 'epoch': selected_epochs, 'trained_epochs': trained_epochs,
+            'step_time': step_times, 'first_step_time': first_step_times, 'selected_time': selected_times,
+            'peak_memory': peak_memories, 'val_curves': val_curves, 'subsample': subsample}
+
+def report(results):
+    """Prints the summary of train() results that train.py ends with."""
+    if not FLAGS.verbose:
+        runs = results['test_acc']
+        print(runs)
+        runs = runs[runs > 0]
+        print((np.mean(runs), stats.sem(runs)))
+        print("seconds per training step:", "{:.5f}".format(np.mean(results['step_time'])))
+        print("seconds for first training step:", "{:.5f}".format(np.mean(results['first_step_time'])))
+        print("seconds to selected epoch:", "{:.5f}".format(np.mean(results['selected_time'])))
+        if FLAGS.measure_memory:
+            print("peak memory (MB):", "{:.1f}".format(results['peak_memory'][0] / 2.**20))
+
+def main():
+    report(train())
+
+if __name__ == '__main__':
+    main()
@@ -11,7 +11,6 @@ setup(name='gae',
       license='MIT',
       install_requires=['numpy',
                         'tensorflow',
-                        'networkx',
                         'scikit-learn',
                         'scipy',
                         ],